@@ -1,35 +1,41 @@
 import argparse
+import asyncio
 import os
-import torch
-import torch.distributed as dist
 from innovation.gendata.methods.method_manager import MethodManager, BaseMethod
 from innovation.gendata.models.model_manager import ModelManager, BaseModel
+from innovation.gendata.models.response_cache import ResponseCache, CachedModel
 import importlib
 from innovation.gendata.utils.logger import setup_logger
-from innovation.gendata.utils import utils
+from innovation.gendata.utils import distributed, utils
+from innovation.gendata.utils.pipeline import StagePipeline
+from innovation.gendata.utils.scheduler import ChunkScheduler, StoreCounter, FileCounter, get_default_store
+from innovation.gendata.utils.metrics import metrics, stage_scope, ThroughputReporter, merge_snapshots, write_report, log_summary
+from innovation.gendata.utils import batch
+from collections import Counter
 import time
 
 logger = setup_logger(__name__)
 
 
 def init_distributed():
-    
-    """Initialize distributed processing with MPI backend."""
+    """Initialize distributed processing with the gloo backend when launched with more than one process.
+
+    A single process, e.g. without torchrun, runs without a process group: torch is
+    not imported, no port is taken for the rendezvous and barriers are no-ops.
+    """
+
+    world_size = int(os.environ.get('WORLD_SIZE', 1))  # Default world size 1 if not set
+    if world_size <= 1:
+        return 1, 0, -1
+
+    import torch
+    import torch.distributed as dist
 
     # Check if the environment variables are set by torchrun
-    
     if 'MASTER_ADDR' not in os.environ:
         os.environ['MASTER_ADDR'] = 'localhost'  # Set the master node address (use 'localhost' or the actual master node)
         os.environ['MASTER_PORT'] = '29500'
 
-    rank = int(os.environ.get('RANK', 0))  # Default rank 0 if not set
-    world_size = int(os.environ.get('WORLD_SIZE', 1))  # Default world size 1 if not set
-    
-    # If not using torchrun, set the default rank to 0 manually
-    if 'RANK' not in os.environ:
-        os.environ['RANK'] = str(rank)
-        os.environ['WORLD_SIZE'] = str(world_size)
-        
     dist.init_process_group(backend="gloo")  # Or "gloo" for CPU-only
 
     world_size = dist.get_world_size()  # Total number of processes
@@ -42,49 +48,256 @@ def init_distributed():
 
 class SyntheticDataGenerator:
 
+    @staticmethod
+    def _save_record(data_instance, model, data, i):
+        if isinstance(data, list):
+            # One output record per variant, variants written before an interruption are not written again.
+            for variant, record in enumerate(data):
+                if data_instance.is_variant_done(i, variant):
+                    continue
+                record[data_instance.unique_key] = data_instance.get_variant_id(i, variant)
+                record["variant"] = variant
+                record["model"] = model
+                data_instance.set_record(record, i)
+            return
+        data[data_instance.unique_key] = data_instance.get_unique_id(i)
+        data["model"] = model
+        data_instance.set_record(data, i)
+
+    @classmethod
+    def _get_indices(cls, data_instance, output, scheduler, chunk_size, global_rank, world_size):
+        """Returns the indices this rank has to generate, either a static slice or a dynamic queue."""
+        if scheduler == "static":
+            start_idx, end_idx = utils.get_shard_range(len(data_instance), global_rank, world_size)
+            return range(start_idx, end_idx)
+
+        store = get_default_store()
+        if store is not None:
+            counter = StoreCounter(store, f"gendata/{os.path.abspath(output)}/chunk")
+        else:
+            counter = FileCounter(utils.generate_lease_path(output))
+            if global_rank == 0:
+                counter.reset()
+        distributed.barrier()
+
+        # Already-done records are excluded before chunking, so every chunk holds real work.
+        pending = data_instance.pending_indices()
+        logger.info(f"{len(pending)}/{len(data_instance)} records pending, handed out in chunks of {chunk_size}.")
+        return ChunkScheduler(pending, chunk_size, counter)
+
+    @staticmethod
+    def _record_processed(i, end_idx, execution_time):
+        metrics.inc("records_total")
+        metrics.observe("record_latency_seconds", execution_time)
+        logger.info(f"Record {i}/{end_idx} processed in time: {execution_time:.6f} seconds")
+
+    @classmethod
+    def _generate(cls, data_instance, model_instance, indices):
+        model = model_instance.get_model_name()
+        end_idx = len(data_instance)
+        for i in indices:
+            start_time_tmp = time.time()
+            if not data_instance.is_done(i):
+                data = data_instance.generate_data(i, model_instance.get_response)
+                cls._save_record(data_instance, model, data, i)
+
+                cls._record_processed(i, end_idx, time.time() - start_time_tmp)
+            else:
+                logger.info(f"Record {i}/{end_idx} skiped.")
+
     @classmethod
-    def run(cls, method, method_args, model, model_args, input, output, wait_for_model, finish, global_rank, world_size):
+    async def _generate_async(cls, data_instance, model_instance, indices, concurrency):
+        """Generates records keeping up to `concurrency` of them in flight at once."""
+        model = model_instance.get_model_name()
+        end_idx = len(data_instance)
+        indices = iter(indices)
+
+        async def worker():
+            # Workers share the same iterator, so each index is handed out exactly once.
+            for i in indices:
+                start_time_tmp = time.time()
+                if not data_instance.is_done(i):
+                    data = await data_instance.agenerate_data(i, model_instance.aget_response)
+                    cls._save_record(data_instance, model, data, i)
+
+                    cls._record_processed(i, end_idx, time.time() - start_time_tmp)
+                else:
+                    logger.info(f"Record {i}/{end_idx} skiped.")
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await model_instance.aclose()
+
+    @classmethod
+    async def _generate_pipeline(cls, data_instance, model_instance, indices, concurrency):
+        """Generates records stage by stage, with `concurrency` workers per task of `messages_list`."""
+        model = model_instance.get_model_name()
+        end_idx = len(data_instance)
+
+        def on_record(i, data, execution_time):
+            cls._save_record(data_instance, model, data, i)
+            cls._record_processed(i, end_idx, execution_time)
+
+        pipeline = StagePipeline(data_instance, model_instance.aget_response, workers=concurrency, queue_size=concurrency)
+        try:
+            await pipeline.run(indices, on_record)
+        finally:
+            await model_instance.aclose()
+
+    @classmethod
+    def _batch_import(cls, data_instance, model_instance, path):
+        """Joins the results of an OpenAI Batch output file back to their records by `custom_id`.
+
+        Intermediate tasks are saved as stage checkpoints, records whose last task is
+        answered are written. Failed, cut or missing results leave their record at the
+        same task, so it is exported again.
+        """
+        model = model_instance.get_model_name()
+        counts = Counter()
+        # Responses of fanned-out records are applied once every variant has one.
+        partial = {}
+        for request_id, body, error in batch.read_results(path):
+            try:
+                i, task, variant = data_instance.batch_target(request_id)
+            except (KeyError, ValueError):
+                counts["unknown"] += 1
+                continue
+            if data_instance.is_done(i) or data_instance.resume_stage(i) != task:
+                # Results of tasks that were already imported.
+                counts["stale"] += 1
+                continue
+            if error is not None:
+                logger.warning(f"Batch request {request_id} failed: {error}")
+                counts["failed"] += 1
+                continue
+            try:
+                with stage_scope(task):
+                    response = model_instance.parse_batch_response(body, **data_instance.request_args(task))
+            except Exception as err:
+                logger.warning(f"Batch request {request_id} has no usable response: {err}")
+                counts["failed"] += 1
+                continue
+            if variant is not None:
+                responses = partial.setdefault(i, {})
+                responses[variant] = response
+                if len(responses) < data_instance.variants:
+                    continue
+                response = [responses.pop(variant) for variant in range(data_instance.variants)]
+                del partial[i]
+
+            data = data_instance.apply_batch_response(i, task, response)
+            counts[f"task {task}"] += 1
+            if data is not None:
+                cls._save_record(data_instance, model, data, i)
+                data_instance.mark_done(i)
+                metrics.inc("records_total")
+        if partial:
+            counts["incomplete variants"] = len(partial)
+        logger.info(f"Imported {path}: {', '.join(f'{count} {name}' for name, count in sorted(counts.items())) or 'no results'}.")
+
+    @staticmethod
+    def _batch_export(data_instance, model_instance, path):
+        """Writes the first incomplete task of every pending record as an OpenAI Batch input file."""
+        tasks = Counter()
+
+        def requests():
+            for request_id, task, messages, request_args in data_instance.batch_requests(data_instance.pending_indices()):
+                tasks[task] += 1
+                with stage_scope(task):
+                    yield request_id, model_instance.batch_body(messages, **request_args)
+
+        count = batch.write_requests(path, requests())
+        logger.info(f"Exported {count} requests to {path} ({', '.join(f'task {task}: {n}' for task, n in sorted(tasks.items()))}).")
+
+    @classmethod
+    def _run_batch(cls, data_instance, model_instance, batch_import, batch_export, global_rank, writer_args):
+        """Runs the batch mode on rank 0 and returns the number of records still pending on every rank."""
+        pending = [0]
+        if global_rank == 0:
+            if batch_import:
+                data_instance.open_writer(**writer_args)
+                try:
+                    cls._batch_import(data_instance, model_instance, batch_import)
+                finally:
+                    data_instance.close_writer()
+                # The next export starts after the tasks just checkpointed.
+                data_instance.reload_checkpoints()
+            pending[0] = len(data_instance.pending_indices())
+            if batch_export and pending[0]:
+                cls._batch_export(data_instance, model_instance, batch_export)
+            if pending[0]:
+                logger.info(f"{pending[0]}/{len(data_instance)} records pending, run the exported batch and import its results with --batch-import.")
+        distributed.broadcast_object_list(pending, src=0)
+        return pending[0]
+
+    @staticmethod
+    def _report_metrics(global_rank, world_size, metrics_report):
+        """Gathers the metrics of every rank, logs a summary and writes the report from rank 0."""
+        snapshots = [None] * world_size
+        distributed.all_gather_object(snapshots, metrics.snapshot())
+        if global_rank == 0:
+            log_summary(merge_snapshots(snapshots))
+            if metrics_report:
+                write_report(snapshots, metrics_report)
+                logger.info(f"Metrics report written to {metrics_report}.")
+
+    @classmethod
+    def run(cls, method, method_args, model, model_args, input, output, wait_for_model, finish, global_rank, world_size, concurrency=1, scheduler="dynamic", chunk_size=8, pipeline=False, cache=None, cache_max_size=1024, writer_args={}, finish_mode="merge", metrics_interval=30, metrics_report=None, batch_import=None, batch_export=None):
         model_instance:BaseModel = ModelManager.get_class(model)(**model_args)
+        if cache:
+            model_instance = CachedModel(model_instance, ResponseCache(cache, cache_max_size))
         data_instance:BaseMethod = MethodManager.get_class(method)(input, output, global_rank, wait_for_model, **method_args)
+        if data_instance.variants > 1 and not model_instance.supports_n():
+            raise ValueError(f"'variants' in the task file needs a model API whose get_response accepts `n`, '{model}' does not.")
 
         if global_rank == 0:
             model_instance.print_args()
             data_instance.print_args()
-        torch.distributed.barrier()
+        distributed.barrier()
 
         start_time = time.time()
-        if not finish:
-            total = len(data_instance)
-            local_size = total // world_size
-            remainder = total % world_size
-
-            # Distribute remainder elements across initial ranks
-            if global_rank < remainder:
-                start_idx = global_rank * (local_size + 1)
-                end_idx = start_idx + local_size + 1
-            else:
-                start_idx = global_rank * local_size + remainder
-                end_idx = start_idx + local_size
-            
-            model = model_instance.get_model_name()
-            logger.info(f"Starting generating data.")
-            for i in range(start_idx, end_idx):
-                start_time_tmp = time.time()
-                if not data_instance.is_done(i):
-                    data = data_instance.generate_data(i, model_instance.get_response)
-                    data[data_instance.unique_key] = data_instance.get_unique_id(i)
-                    data["model"] = model
-                    data_instance.set_record(data, i)
+        if batch_import or batch_export:
+            if cls._run_batch(data_instance, model_instance, batch_import, batch_export, global_rank, writer_args):
+                # The output is only saved once every record went through all of its tasks.
+                return
+        elif not finish:
+            indices = cls._get_indices(data_instance, output, scheduler, chunk_size, global_rank, world_size)
 
-                    execution_time = time.time() - start_time_tmp
-                    logger.info(f"Record {i}/{end_idx} processed in time: {execution_time:.6f} seconds")
-                else:
-                    logger.info(f"Record {i}/{end_idx} skiped.")
-
-        torch.distributed.barrier()
+            logger.info(f"Starting generating data.")
+            metrics.reset()
+            data_instance.open_writer(**writer_args)
+            try:
+                with ThroughputReporter(metrics_interval):
+                    if pipeline:
+                        asyncio.run(cls._generate_pipeline(data_instance, model_instance, indices, concurrency))
+                    elif concurrency > 1:
+                        asyncio.run(cls._generate_async(data_instance, model_instance, indices, concurrency))
+                    else:
+                        cls._generate(data_instance, model_instance, indices)
+            finally:
+                data_instance.close_writer()
+
+            model_instance.log_stats()
+            cls._report_metrics(global_rank, world_size, metrics_report)
+
+        distributed.barrier()
+        if finish_mode == "parallel":
+            data_instance.save_part(global_rank, world_size)
+            distributed.barrier()
         if global_rank == 0:
             execution_time = time.time() - start_time
-            data_instance.save_all()
+            if finish_mode == "parallel":
+                data_instance.merge_parts(world_size)
+            else:
+                data_instance.save_all()
+            lease_path = utils.generate_lease_path(output)
+            if os.path.exists(lease_path):
+                os.remove(lease_path)
             logger.info(f"Saved all record.")
 
 
@@ -103,25 +316,30 @@ def main():
     parser.add_argument("--list-data-methods", action="store_true", help="List all available methods to generate dataset.")
     parser.add_argument("--list-model-apis", action="store_true", help="List all available models.")
     parser.add_argument("--wait-for-model", action="store_true", help="Wait for the model, if not available it will keep wait in a loop, this si good if your connection is not stable.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of records generated concurrently per rank with asyncio. By default records are generated one after another.")
+    parser.add_argument("--pipeline", action="store_true", help="Pipeline the tasks of `messages_list`: each task becomes a stage with its own bounded queue and --concurrency workers, so different records run different tasks at the same time.")
+    parser.add_argument("--scheduler", type=str, default="dynamic", choices=["dynamic", "static"], help="How records are distributed across ranks: `dynamic` hands out chunks of pending records on demand, `static` gives each rank a fixed contiguous slice.")
+    parser.add_argument("--chunk-size", type=int, default=8, help="Number of pending records handed out at once by the dynamic scheduler.")
+    parser.add_argument("--cache", type=str, default=None, help="Path to a SQLite file used as a persistent response cache, keyed by model, model params and messages. Shared safely by all ranks on the same node.")
+    parser.add_argument("--cache-max-size", type=float, default=1024, help="Maximum size of the response cache in MB, least recently used responses are evicted first.")
+    parser.add_argument("--flush-interval", type=float, default=1.0, help="Maximum seconds a generated record waits in memory before it is written to the temporary output.")
+    parser.add_argument("--flush-size", type=int, default=64, help="Number of generated records written to the temporary output at once.")
+    parser.add_argument("--fsync", type=str, default="none", choices=["none", "close", "batch"], help="When the temporary output is synced to disk: left to the OS (`none`), when generation ends (`close`) or after every write (`batch`).")
     parser.add_argument("--finish", action="store_true", help="Complete generating dataset, if any data is saved in temporary files and will be moved to the output path.")
+    parser.add_argument("--finish-mode", type=str, default="merge", choices=["merge", "parallel"], help="How the output is saved at the end: `merge` lets rank 0 write it alone, `parallel` has every rank write a part (parquet outputs become a directory of parts with a manifest).")
+    parser.add_argument("--metrics-interval", type=float, default=30, help="Seconds between live throughput lines in the log, 0 disables them.")
+    parser.add_argument("--metrics-report", type=str, default=None, help="Path where rank 0 writes the metrics gathered from all ranks: a Prometheus textfile if it ends in `.prom`, JSON otherwise.")
+    parser.add_argument("--batch-export", type=str, default=None, help="Instead of calling the model, write the next task of every pending record to this path as an OpenAI Batch input file (JSONL, `custom_id` is `<unique key>:<task>`), e.g. for `vllm run-batch`.")
+    parser.add_argument("--batch-import", type=str, default=None, help="Join the results of an OpenAI Batch output file back to their records by `custom_id`. Can be combined with --batch-export to export the following task in the same run, the output is saved once no record is pending.")
     parser.add_argument("--generate-task-sample", type=str, default=None, choices=["simple", "complex"], help="Generate a example task file.")
-    parser.add_argument("--generate-model-params", type=str, default=None, choices=["openai"], help="Generate a example model parameters file.")
+    parser.add_argument("--generate-model-params", type=str, default=None, choices=["openai", "local"], help="Generate a example model parameters file.")
     import sys
 
-    world_size, global_rank, _ = init_distributed()
-
-
-    if '--help' in sys.argv:
+    # Arguments are parsed before the process group is set up, so help and utility commands return right away.
+    global_rank = distributed.get_rank()
+    if ('--help' in sys.argv or '-h' in sys.argv) and global_rank != 0:
         # Only print the help message when rank == 0
-        if dist.is_initialized():
-            rank = dist.get_rank()
-            if rank == 0:
-                parser.print_help()
-            dist.barrier()  # Ensure all processes reach this point
-        else:
-            parser.print_help()
         return
-    # Initialize distributed processing
 
     args = parser.parse_args()
     current_dir = os.path.dirname(__file__)
@@ -172,6 +390,9 @@ def main():
         if global_rank == 0:
             parser.error(",".join(errors) + " are required.")
         return
+
+    # Initialize distributed processing
+    world_size, global_rank, _ = init_distributed()
     
     if global_rank == 0:
         if os.path.exists(args.output):
@@ -181,7 +402,7 @@ def main():
         if parent_dir:  # Only try to create if there's a directory part
             os.makedirs(parent_dir, exist_ok=True)
 
-    torch.distributed.barrier()
+    distributed.barrier()
 
     task = utils.read_yaml(args.task)
 
@@ -192,8 +413,10 @@ def main():
     model_args = dict(pair.split('=') for pair in args.model_args.split(',')) if args.model_args else {}
     model_args["model_params"] = utils.read_yaml(args.model_params) if args.model_params else {}
 
-    SyntheticDataGenerator.run(args.data_method, data_args, args.model, model_args, args.input, args.output, args.wait_for_model, args.finish, global_rank, world_size)
-    torch.distributed.barrier()
+    writer_args = {"flush_interval": args.flush_interval, "flush_size": args.flush_size, "fsync": args.fsync}
+
+    SyntheticDataGenerator.run(args.data_method, data_args, args.model, model_args, args.input, args.output, args.wait_for_model, args.finish, global_rank, world_size, args.concurrency, args.scheduler, args.chunk_size, args.pipeline, args.cache, args.cache_max_size, writer_args, args.finish_mode, args.metrics_interval, args.metrics_report, args.batch_import, args.batch_export)
+    distributed.barrier()
 if __name__ == "__main__":
     main()
 
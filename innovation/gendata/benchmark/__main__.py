@@ -0,0 +1,236 @@
+import argparse
+import copy
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import yaml
+from typing import Any, Dict, List
+from innovation.gendata.benchmark.mock_server import MockServer
+from innovation.gendata.utils import utils
+from innovation.gendata.utils.logger import setup_logger
+from innovation.gendata.utils.metrics import Histogram
+
+logger = setup_logger(__name__)
+
+GENDATA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "configs", "default.yml")
+
+# Placeholders of a task that are filled from the input record, `{{...}}` being escaped braces.
+_PLACEHOLDER = re.compile(r"(?<!\{)\{(\w+)\}(?!\})")
+
+
+def load_task(task: str) -> dict:
+    """Reads a task file, `simple` and `complex` being the shipped examples."""
+    if task in ("simple", "complex"):
+        task = os.path.join(GENDATA_DIR, "tasks_examples", f"{task}.yml")
+    return utils.read_yaml(task), task
+
+
+def input_columns(task: dict) -> List[str]:
+    """Keys the input records need for every placeholder of the task."""
+    generated = set(task.get("output_keys", [])) | set(task.get("random_extra_keys", {}) or {})
+    columns = {}
+    for messages in task["messages_list"]:
+        for message in messages:
+            for key in _PLACEHOLDER.findall(str(message.get("content", ""))):
+                if key not in generated:
+                    columns[key] = None
+    return list(columns)
+
+
+def write_dataset(path: str, columns: List[str], records: int, record_size: int, seed: int = 0):
+    """Writes `records` synthetic records with an `id` and `record_size` characters in every column."""
+    import pandas as pd
+    rng = random.Random(seed)
+    words = "alpha beta gamma delta epsilon zeta eta theta iota kappa lambda mu".split()
+
+    def text():
+        value = ""
+        while len(value) < record_size:
+            value += rng.choice(words) + " "
+        return value[:record_size]
+
+    data = [{"id": f"r{i}", **{column: text() for column in columns}} for i in range(records)]
+    file_type = os.path.splitext(path)[1].lstrip(".").lower()
+    if file_type == "jsonl":
+        with open(path, "w", encoding="utf-8") as f:
+            for record in data:
+                f.write(json.dumps(record) + "\n")
+    elif file_type == "json":
+        pd.DataFrame(data).to_json(path, orient="records")
+    elif file_type == "csv":
+        pd.DataFrame(data).to_csv(path, index=False)
+    elif file_type == "parquet":
+        pd.DataFrame(data).to_parquet(path, index=False)
+    else:
+        raise ValueError(f"Unsupported file type: {file_type}")
+
+
+def _merge(defaults: dict, config: dict) -> dict:
+    merged = copy.deepcopy(defaults)
+    for key, value in config.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = {**merged[key], **value}
+        else:
+            merged[key] = value
+    return merged
+
+
+def _gendata_command(config: dict, workdir: str, server_url: str) -> List[str]:
+    ranks = int(config.get("ranks", 1))
+    if ranks > 1:
+        command = [sys.executable, "-m", "torch.distributed.run", "--standalone", f"--nproc_per_node={ranks}", "-m", "innovation.gendata"]
+    else:
+        command = [sys.executable, "-m", "innovation.gendata"]
+    command += [
+        "--input", os.path.join(workdir, f"input.{config.get('input_format', 'jsonl')}"),
+        "--output", os.path.join(workdir, "output", f"data.{config.get('output_format', 'jsonl')}"),
+        "--task", config["task_path"],
+        "--model", config.get("model", "openai"),
+        "--unique-key", "id",
+        "--model-args", f"{config.get('url_arg', 'api_url')}={server_url},model=mock",
+        "--model-params", os.path.join(workdir, "model_params.yml"),
+        "--concurrency", str(config.get("concurrency", 1)),
+        "--metrics-report", os.path.join(workdir, "metrics.json"),
+        "--metrics-interval", "0",
+    ]
+    if config.get("pipeline"):
+        command.append("--pipeline")
+    return command + [str(arg) for arg in config.get("args", [])]
+
+
+def _latencies(histogram: dict) -> Dict[str, Any]:
+    return {q: histogram.get(q) for q in ("p50", "p95", "p99")} if histogram else {"p50": None, "p95": None, "p99": None}
+
+
+def run_config(config: dict, workdir: str) -> dict:
+    """Runs gendata once for `config` against a fresh mock server and returns its results."""
+    os.makedirs(workdir, exist_ok=True)
+    task, config["task_path"] = load_task(config.get("task", "simple"))
+    write_dataset(os.path.join(workdir, f"input.{config.get('input_format', 'jsonl')}"), input_columns(task),
+                  int(config.get("records", 100)), int(config.get("record_size", 200)), int(config.get("seed", 0)))
+    model_params = {"max_tokens": 256, **(config.get("model_params") or {})}
+    with open(os.path.join(workdir, "model_params.yml"), "w", encoding="utf-8") as f:
+        yaml.safe_dump(model_params, f)
+
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.dirname(GENDATA_DIR))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [package_root, env.get("PYTHONPATH")]))
+    for key in ("RANK", "WORLD_SIZE", "LOCAL_RANK", "MASTER_ADDR", "MASTER_PORT"):
+        env.pop(key, None)
+
+    with MockServer(**(config.get("server") or {})) as server:
+        url_arg = config.get("url_arg", "api_url")
+        urls = "|".join([server.url] * int(config.get("replicas", 1))) if url_arg == "api_urls" else server.url
+        command = _gendata_command(config, workdir, urls)
+        logger.info(f"Running benchmark '{config['name']}': {' '.join(command)}")
+        start = time.time()
+        with open(os.path.join(workdir, "gendata.log"), "w", encoding="utf-8") as log:
+            process = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=workdir)
+        wall = time.time() - start
+        server_stats = dict(server.stats)
+
+    result = {"name": config["name"], "ranks": int(config.get("ranks", 1)), "concurrency": int(config.get("concurrency", 1)),
+              "pipeline": bool(config.get("pipeline")), "task": config.get("task", "simple"), "records": int(config.get("records", 100)),
+              "wall_seconds": wall, "returncode": process.returncode, "server": server_stats}
+    if process.returncode != 0:
+        with open(os.path.join(workdir, "gendata.log"), encoding="utf-8") as log:
+            tail = log.readlines()[-20:]
+        logger.error(f"Benchmark '{config['name']}' failed with code {process.returncode}:\n{''.join(tail)}")
+        return result
+
+    with open(os.path.join(workdir, "metrics.json"), encoding="utf-8") as f:
+        report = json.load(f)
+    total = report["total"]
+    histograms = total["histograms"]
+    generated = sum(total["counters"].get("records_total", {}).values())
+    result.update({
+        "generated": generated,
+        "records_per_second": generated / total["elapsed"] if total["elapsed"] else None,
+        "wall_records_per_second": generated / wall if wall else None,
+        "record_latency": _latencies(histograms.get("record_latency_seconds", {}).get("none")),
+        "request_latency": _latencies(_merge_stages(histograms.get("request_latency_seconds", {}))),
+        "peak_rss_mb": total.get("peak_rss_bytes", 0) / 2 ** 20,
+        "total_rss_mb": sum(rank.get("peak_rss_bytes", 0) for rank in report["ranks"]) / 2 ** 20,
+    })
+    return result
+
+
+def _merge_stages(stages: dict) -> dict:
+    """Request latency over all stages, merged from the per-stage histograms."""
+    histogram = Histogram()
+    for data in stages.values():
+        histogram.merge(Histogram.from_dict(data))
+    return histogram.to_dict() if histogram.count else {}
+
+
+def _format(value, spec):
+    return format(value, spec) if value is not None else "-"
+
+
+def print_results(results: List[dict], baseline: Dict[str, dict] = None):
+    header = f"{'name':<24} {'ranks':>5} {'conc':>5} {'records/s':>10} {'wall rec/s':>10} {'rec p50':>8} {'rec p95':>8} {'rec p99':>8} {'req p95':>8} {'peak MB':>8}"
+    if baseline:
+        header += f" {'Δ rec/s':>8} {'Δ p95':>8}"
+    print(header)
+    for result in results:
+        if result["returncode"] != 0:
+            print(f"{result['name']:<24} failed with code {result['returncode']}")
+            continue
+        line = (f"{result['name']:<24} {result['ranks']:>5} {result['concurrency']:>5} {_format(result['records_per_second'], '10.2f')} "
+                f"{_format(result['wall_records_per_second'], '10.2f')} {_format(result['record_latency']['p50'], '8.3f')} "
+                f"{_format(result['record_latency']['p95'], '8.3f')} {_format(result['record_latency']['p99'], '8.3f')} "
+                f"{_format(result['request_latency']['p95'], '8.3f')} {_format(result['peak_rss_mb'], '8.1f')}")
+        previous = (baseline or {}).get(result["name"])
+        if previous and previous.get("returncode") == 0:
+            throughput = 100 * (result["records_per_second"] / previous["records_per_second"] - 1) if previous.get("records_per_second") else None
+            p95 = 100 * (result["record_latency"]["p95"] / previous["record_latency"]["p95"] - 1) if previous["record_latency"].get("p95") else None
+            line += f" {_format(throughput, '+7.1f')}% {_format(p95, '+7.1f')}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure gendata throughput against a local mock OpenAI-compatible server.")
+    parser.add_argument("--config", type=str, default=DEFAULT_CONFIG, help="YAML file with `defaults` and a list of `configs` to run.")
+    parser.add_argument("--only", type=str, default=None, help="Comma separated names of the configurations to run.")
+    parser.add_argument("--output", type=str, default=None, help="Path to write the results as JSON.")
+    parser.add_argument("--baseline", type=str, default=None, help="Results JSON of a previous run to compare against.")
+    parser.add_argument("--workdir", type=str, default=None, help="Directory for datasets, outputs and logs, a temporary one by default.")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory after the benchmark.")
+    args = parser.parse_args()
+
+    suite = utils.read_yaml(args.config)
+    defaults = suite.get("defaults", {}) or {}
+    configs = [_merge(defaults, config) for config in suite["configs"]]
+    if args.only:
+        names = set(args.only.split(","))
+        configs = [config for config in configs if config["name"] in names]
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="gendata_benchmark_")
+    results = []
+    try:
+        for config in configs:
+            results.append(run_config(config, os.path.join(workdir, config["name"])))
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = {result["name"]: result for result in json.load(f)["results"]}
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"config": os.path.abspath(args.config), "python": sys.version.split()[0], "results": results}, f, indent=2)
+        logger.info(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
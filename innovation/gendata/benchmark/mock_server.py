@@ -0,0 +1,245 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under load, adding TCP retransmission delays to the measurements.
+    request_queue_size = 1024
+
+
+_WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+class MockServer:
+    """Local stand-in for an OpenAI-compatible chat completions server.
+
+    A response takes a base latency drawn from the latency distribution plus the time
+    to produce `completion_tokens` at `tokens_per_second`. Conversations mentioning JSON
+    get a JSON object as answer, other prompts get plain words. A request whose
+    `max_tokens` is below `completion_tokens` is cut there with finish reason `length`.
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port to listen on, 0 picks a free one.
+        latency (str): Base latency distribution: `constant`, `uniform`, `exponential` or `lognormal`.
+        latency_mean (float): Mean base latency in seconds.
+        latency_sigma (float): Spread of the `lognormal` distribution, or half width of the `uniform` one.
+        tokens_per_second (float): Generation speed of a single request, 0 for instant generation.
+        completion_tokens (int): Tokens (words) in every completion.
+        error_rate (float): Fraction of requests answered with a 500 error.
+        rate_limit_rate (float): Fraction of requests answered with a 429 error.
+        max_concurrency (int, optional): Requests in flight above this are answered with 429.
+        retry_after (float): `Retry-After` seconds sent with 429 errors.
+        seed (int, optional): Seed of the random generator.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: str = "lognormal", latency_mean: float = 0.2, latency_sigma: float = 0.5,
+                 tokens_per_second: float = 0, completion_tokens: int = 50, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 max_concurrency: Optional[int] = None, retry_after: float = 1.0, seed: Optional[int] = None):
+        if latency not in ("constant", "uniform", "exponential", "lognormal"):
+            raise ValueError(f"Unsupported latency distribution: {latency}")
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_concurrency = max_concurrency
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+        self._server = _Server((host, port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/"
+
+    def _base_latency(self):
+        with self._lock:
+            if self.latency == "constant":
+                return self.latency_mean
+            if self.latency == "uniform":
+                return max(0.0, self._random.uniform(self.latency_mean - self.latency_sigma, self.latency_mean + self.latency_sigma))
+            if self.latency == "exponential":
+                return self._random.expovariate(1 / self.latency_mean) if self.latency_mean > 0 else 0.0
+            # Lognormal with the requested mean: mu = log(mean) - sigma^2 / 2.
+            mu = -0.5 * self.latency_sigma ** 2
+            return self.latency_mean * self._random.lognormvariate(mu, self.latency_sigma)
+
+    def _outcome(self):
+        """Returns the error status to answer with, or None to answer normally."""
+        with self._lock:
+            self.stats["requests"] += 1
+            if self.max_concurrency is not None and self._inflight >= self.max_concurrency:
+                self.stats["rate_limited"] += 1
+                return 429
+            draw = self._random.random()
+            if draw < self.rate_limit_rate:
+                self.stats["rate_limited"] += 1
+                return 429
+            if draw < self.rate_limit_rate + self.error_rate:
+                self.stats["errors"] += 1
+                return 500
+            self._inflight += 1
+            return None
+
+    def _done(self):
+        with self._lock:
+            self._inflight -= 1
+
+    def _completion(self, messages, index):
+        prompt = " ".join(str(message.get("content", "")) for message in messages)
+        words = [_WORDS[(index + i) % len(_WORDS)] for i in range(self.completion_tokens)]
+        if "json" in prompt.lower():
+            return json.dumps({"result": " ".join(words[:-1]), "index": index})
+        return " ".join(words)
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    for key, value in (headers or {}).items():
+                        self.send_header(key, value)
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up on the request, e.g. the losing copy of a hedged request.
+                    self.close_connection = True
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/models"):
+                    self._send_json(200, {"object": "list", "data": [{"id": "mock", "object": "model", "created": 0, "owned_by": "benchmark"}]})
+                else:
+                    self._send_json(404, {"error": {"message": "Not found"}})
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                status = server._outcome()
+                if status == 429:
+                    self._send_json(429, {"error": {"message": "Rate limited", "type": "rate_limit_error"}}, {"Retry-After": str(server.retry_after)})
+                    return
+                if status == 500:
+                    self._send_json(500, {"error": {"message": "Internal error", "type": "server_error"}})
+                    return
+                try:
+                    self._complete(request)
+                finally:
+                    server._done()
+
+            def _complete(self, request):
+                messages = request.get("messages", [])
+                n = request.get("n") or 1
+                time.sleep(server._base_latency())
+                contents = [server._completion(messages, k) for k in range(n)]
+                tokens = server.completion_tokens
+                finish_reason = "stop"
+                max_tokens = request.get("max_tokens") or request.get("max_completion_tokens")
+                if max_tokens is not None and max_tokens < tokens:
+                    tokens, finish_reason = max_tokens, "length"
+                    contents = [" ".join(content.split(" ")[:tokens]) for content in contents]
+                token_time = tokens / server.tokens_per_second if server.tokens_per_second > 0 else 0.0
+                prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in messages)
+                if request.get("stream"):
+                    self._stream(request, contents[0], token_time, finish_reason)
+                    return
+                time.sleep(token_time)
+                self._send_json(200, {
+                    "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": request.get("model", "mock"),
+                    "choices": [{"index": k, "finish_reason": finish_reason, "message": {"role": "assistant", "content": content}} for k, content in enumerate(contents)],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": tokens * n, "total_tokens": prompt_tokens + tokens * n},
+                })
+
+            def _stream(self, request, content, token_time, finish_reason):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                pieces = content.split(" ")
+                delay = token_time / len(pieces) if pieces else 0.0
+                try:
+                    for i, piece in enumerate(pieces):
+                        delta = {"role": "assistant", "content": piece} if i == 0 else {"content": " " + piece}
+                        chunk = {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": request.get("model", "mock"),
+                                 "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+                        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                        self.wfile.flush()
+                        time.sleep(delay)
+                    chunk = {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": request.get("model", "mock"),
+                             "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode())
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client aborted the stream early.
+                    pass
+                self.close_connection = True
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="MockServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible server for gendata benchmarks.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("--latency", type=str, default="lognormal", choices=["constant", "uniform", "exponential", "lognormal"], help="Base latency distribution.")
+    parser.add_argument("--latency-mean", type=float, default=0.2, help="Mean base latency in seconds.")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="Spread of the latency distribution.")
+    parser.add_argument("--tokens-per-second", type=float, default=0, help="Generation speed of a single request, 0 for instant generation.")
+    parser.add_argument("--completion-tokens", type=int, default=50, help="Tokens in every completion.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500 error.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of requests answered with a 429 error.")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="Requests in flight above this are answered with 429.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429 errors.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the random generator.")
+    args = parser.parse_args()
+
+    server = MockServer(**{key: value for key, value in vars(args).items()})
+    logger.info(f"Mock server listening on {server.url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+        logger.info(f"Served {server.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,184 @@
-from innovation.gendata.methods.method_manager import MethodManager, BaseMethod, GetLLMResponseType, MessagesType
-from typing import Dict, Any, List
+from innovation.gendata.methods.method_manager import MethodManager, BaseMethod, GetLLMResponseType, AsyncGetLLMResponseType, MessagesType
+from typing import Dict, Any, Iterator, List, Sequence, Tuple, Union
+import asyncio
 import json
 from innovation.gendata.utils.logger import setup_logger
+from innovation.gendata.utils.metrics import metrics, stage_scope
+import time
 
 logger = setup_logger(__name__)
 
 
 @MethodManager.register("default")
 class Default(BaseMethod):
-    def __init__(self, input: str, output: str, global_rank:int, wait_for_model:bool, messages_list: List[MessagesType], unique_key, output_keys, output_types, random_extra_keys):
-        super().__init__(input, output, global_rank, wait_for_model, messages_list, unique_key, output_keys, output_types, random_extra_keys)
+    """Runs the tasks of `messages_list` one after another on every input record.
 
-    def generate_data(self, index, get_llm_response: GetLLMResponseType) -> Dict[str, Any]:
+    With `variants` > 1 in the task file, task `variants_task` (the first one by
+    default) asks the model for `variants` completions in a single request. Each
+    completion continues as its own record through the following tasks and is
+    written with the unique key `<key>_<variant>`.
+    """
+
+    def __init__(self, input: str, output: str, global_rank:int, wait_for_model:bool, messages_list: List[MessagesType], unique_key, output_keys, output_types, random_extra_keys, variants: int = 1, variants_task: int = 0):
+        super().__init__(input, output, global_rank, wait_for_model, messages_list, unique_key, output_keys, output_types, random_extra_keys, variants, variants_task)
+
+    def init_record(self, index) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
         logger.debug(f"Generating data for field {index}.")
-        
-        # Extract data for the current index and update it with extra keys
-        json_data = self._data.iloc[index].to_dict()
+
+        # Extract the columns used by the templates for the current index and update them with extra keys
+        json_data = self.get_record(index, self.template_columns)
         json_data.update(self.get_extra_keys(index))
-        used_keys = []
-        
-        # Iterate through the messages list to generate responses for each task
-        for i, messages in enumerate(self.messages_list):
-            # Log the task processing start
-            used_keys.extend(self.replaceable_keys[i])
-            logger.debug(f"Generating response for task {i} of field {index}.")
-            messages = self.generate_messages(json_data, i)
-            logger.debug(f"Messages: (task: {i}, field: {index}):\n{json.dumps(messages, indent=4, ensure_ascii=False)}")
-            
-            response = get_llm_response(messages=messages, wait_for_connection=self.wait_for_model)
-            logger.debug(f"LLM Response: (task: {i}, field: {index}):\n{response}")
-            
-            # If the response type is JSON, convert it to JSON format
-            if self.output_types[i] == "json":
-                logger.debug(f"Converting response to JSON: (task: {i}, field: {index})")
-                try:
-                    response = json.loads(response)
-                except Exception as e:
-                    logger.error(f"Faild to converte response to JSON: (task: {i}, field: {index})\nError: {e}")
-                    if json_data.get("json_convertion_error", None) is None:
-                        json_data["json_convertion_error"] = []
-                    json_data["json_convertion_error"].append(self.output_keys[i])
-
-            json_data[self.output_keys[i]] = response
-        
+
+        # Restore the outputs of the tasks an earlier run completed before stopping
+        completed = self.completed_stages(index)
+        for values in completed:
+            if "variants" in values:
+                if not isinstance(json_data, list):
+                    json_data = [self._copy_record(json_data) for _ in values["variants"]]
+                for record, variant_values in zip(json_data, values["variants"]):
+                    self._restore_values(record, variant_values)
+            else:
+                self._restore_values(json_data, values)
+        if completed:
+            logger.debug(f"Resuming field {index} at task {len(completed)}.")
+            metrics.inc("resumed_stages_total", len(completed))
+        return json_data
+
+    @staticmethod
+    def _copy_record(json_data):
+        record = dict(json_data)
+        if "json_convertion_error" in record:
+            record["json_convertion_error"] = list(record["json_convertion_error"])
+        return record
+
+    @staticmethod
+    def _restore_values(json_data, values):
+        for key, value in values.items():
+            if key == "json_convertion_error":
+                json_data.setdefault(key, []).extend(value)
+            else:
+                json_data[key] = value
+
+    def _task_values(self, json_data, i):
+        """Keys task `i` added to a working record, as saved in its stage checkpoint."""
+        if isinstance(json_data, list):
+            return {"variants": [self._task_values(record, i) for record in json_data]}
+        values = {self.output_keys[i]: json_data[self.output_keys[i]]}
+        if self.output_keys[i] in json_data.get("json_convertion_error", []):
+            values["json_convertion_error"] = [self.output_keys[i]]
+        return values
+
+    def _get_task_messages(self, json_data, i, index) -> List[MessagesType]:
+        # Log the task processing start
+        logger.debug(f"Generating response for task {i} of field {index}.")
+        messages = self.generate_messages(json_data, i)
+        logger.debug(f"Messages: (task: {i}, field: {index}):\n{json.dumps(messages, indent=4, ensure_ascii=False)}")
+        return messages
+
+    def _set_task_response(self, json_data, i, index, response):
+        # Several completions fan the record out into one record per variant
+        if isinstance(response, list):
+            return [self._set_task_response(self._copy_record(json_data), i, index, variant_response) for variant_response in response]
+
+        logger.debug(f"LLM Response: (task: {i}, field: {index}):\n{response}")
+
+        # If the response type is JSON, convert it to JSON format
+        if self.output_types[i] == "json":
+            logger.debug(f"Converting response to JSON: (task: {i}, field: {index})")
+            try:
+                response = json.loads(response)
+            except Exception as e:
+                logger.error(f"Faild to converte response to JSON: (task: {i}, field: {index})\nError: {e}")
+                metrics.inc("json_errors_total", stage=i)
+                if json_data.get("json_convertion_error", None) is None:
+                    json_data["json_convertion_error"] = []
+                json_data["json_convertion_error"].append(self.output_keys[i])
+
+        json_data[self.output_keys[i]] = response
+        return json_data
+
+    def finish_record(self, json_data, index) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        if isinstance(json_data, list):
+            return [self.finish_record(record, index) for record in json_data]
         # Log that all tasks have been completed for the current field (index)
         logger.debug(f"Generating data for field {index} done.")
+        used_keys = [key for keys in self.replaceable_keys for key in keys]
         used_keys.extend(self.output_keys)
         # Return the filtered json_data with only the relevant keys
-        return {key: json_data[key] for key in used_keys if key in json_data}
\ No newline at end of file
+        return {key: json_data[key] for key in used_keys if key in json_data}
+
+    def _generate_task(self, json_data, i, index, get_llm_response: GetLLMResponseType):
+        messages = self._get_task_messages(json_data, i, index)
+        start_time = time.time()
+        with stage_scope(i):
+            response = get_llm_response(messages=messages, wait_for_connection=self.wait_for_model, **self.request_args(i))
+        metrics.observe("task_latency_seconds", time.time() - start_time, stage=i)
+        return self._set_task_response(json_data, i, index, response)
+
+    def generate_data(self, index, get_llm_response: GetLLMResponseType) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        json_data = self.init_record(index)
+
+        # Iterate through the messages list to generate responses for each task
+        for i in range(self.resume_stage(index), len(self.messages_list)):
+            if isinstance(json_data, list):
+                json_data = [self._generate_task(record, i, index, get_llm_response) for record in json_data]
+            else:
+                json_data = self._generate_task(json_data, i, index, get_llm_response)
+            self.checkpoint_stage(i, index, self._task_values(json_data, i))
+
+        return self.finish_record(json_data, index)
+
+    async def _agenerate_task(self, json_data, i, index, aget_llm_response: AsyncGetLLMResponseType):
+        messages = self._get_task_messages(json_data, i, index)
+        start_time = time.time()
+        with stage_scope(i):
+            response = await aget_llm_response(messages=messages, wait_for_connection=self.wait_for_model, **self.request_args(i))
+        metrics.observe("task_latency_seconds", time.time() - start_time, stage=i)
+        return self._set_task_response(json_data, i, index, response)
+
+    async def agenerate_task(self, json_data, i, index, aget_llm_response: AsyncGetLLMResponseType):
+        if isinstance(json_data, list):
+            # The variants of a record run the task concurrently
+            json_data = list(await asyncio.gather(*(self._agenerate_task(record, i, index, aget_llm_response) for record in json_data)))
+        else:
+            json_data = await self._agenerate_task(json_data, i, index, aget_llm_response)
+        self.checkpoint_stage(i, index, self._task_values(json_data, i))
+        return json_data
+
+    async def agenerate_data(self, index, aget_llm_response: AsyncGetLLMResponseType) -> Union[Dict[str, Any], List[Dict[str, Any]]]:
+        json_data = self.init_record(index)
+
+        for i in range(self.resume_stage(index), len(self.messages_list)):
+            json_data = await self.agenerate_task(json_data, i, index, aget_llm_response)
+
+        return self.finish_record(json_data, index)
+
+    def batch_requests(self, indices: Sequence[int], chunk_size: int = 1024) -> Iterator[Tuple[str, int, List[MessagesType], Dict[str, Any]]]:
+        # Records that have not started are rendered in bulk, reading only the columns of the first task.
+        fresh = [index for index in indices if self.resume_stage(index) == 0]
+        for start in range(0, len(fresh), chunk_size):
+            chunk = fresh[start:start + chunk_size]
+            for index, messages in zip(chunk, self.render_prompts(chunk, 0)):
+                yield self.batch_id(index, 0), 0, messages, self.request_args(0)
+
+        for index in indices:
+            i = self.resume_stage(index)
+            if i == 0:
+                continue
+            json_data = self.init_record(index)
+            if isinstance(json_data, list):
+                for variant, record in enumerate(json_data):
+                    yield self.batch_id(index, i, variant), i, self._get_task_messages(record, i, index), {}
+            else:
+                yield self.batch_id(index, i), i, self._get_task_messages(json_data, i, index), self.request_args(i)
+
+    def apply_batch_response(self, index, task: int, response: Union[str, List[str]]):
+        json_data = self.init_record(index)
+        if isinstance(json_data, list):
+            json_data = [self._set_task_response(record, task, index, variant_response) for record, variant_response in zip(json_data, response)]
+        else:
+            json_data = self._set_task_response(json_data, task, index, response)
+        if task + 1 < len(self.messages_list):
+            self.checkpoint_stage(task, index, self._task_values(json_data, task))
+            return None
+        return self.finish_record(json_data, index)
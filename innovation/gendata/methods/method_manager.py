@@ -1,21 +1,26 @@
 from abc import ABC, abstractmethod
+import asyncio
 import os
 from pprint import pformat
 import sys
 import importlib.util
 import logging
-from typing import Optional, Type, Union
-import pandas as pd
-import torch
+from typing import Iterator, Optional, Sequence, Tuple, Type, Union
 import json
 import glob
-from innovation.gendata.utils import timer
+from innovation.gendata.utils import distributed, timer, utils
 from innovation.gendata.utils.logger import setup_logger
 from innovation.gendata.utils.class_manager import ClassManager
+from innovation.gendata.utils.readers import RecordReader, open_reader
+from innovation.gendata.utils.templates import CompiledTemplate, compile_messages
+from innovation.gendata.utils.done_index import DoneIndex, hash_keys, key_hash, sidecar_path
+from innovation.gendata.utils.stage_checkpoints import StageCheckpoints, stage_fingerprints
+from innovation.gendata.utils.batch import custom_id, parse_custom_id
+from innovation.gendata.utils.record_writer import RecordWriter, install_handlers
+from innovation.gendata.utils.finalizer import collect_layout, concatenate_parts, merge_layouts, write_output
 from typing import List, Dict, Protocol, Union, Any
 from types import SimpleNamespace
 import numpy as np
-import string
 
 class MessagesType(Dict[str, str]):
     """Defines the message format with 'role' and 'content' keys."""
@@ -29,11 +34,27 @@ class GetLLMResponseType(Protocol):
     Args:
         messages (List[MessagesType]): A list of message dictionaries, each containing 'role' and 'content'.
         wait_for_connection (bool): Whether to wait until a connection is available.
+        n (int, optional): Number of completions to sample from the same prompt in one request.
 
     Returns:
-        str: The generated AI response in text format.
+        str: The generated AI response in text format, or a list of `n` responses when `n` is given.
     """
-    def __call__(self, messages: List[MessagesType], wait_for_connection: bool) -> str:
+    def __call__(self, messages: List[MessagesType], wait_for_connection: bool, n: Optional[int] = None) -> Union[str, List[str]]:
+        pass
+
+
+class AsyncGetLLMResponseType(Protocol):
+    """An awaitable variant of `GetLLMResponseType`, used by the asynchronous execution mode.
+
+    Args:
+        messages (List[MessagesType]): A list of message dictionaries, each containing 'role' and 'content'.
+        wait_for_connection (bool): Whether to wait until a connection is available.
+        n (int, optional): Number of completions to sample from the same prompt in one request.
+
+    Returns:
+        str: The generated AI response in text format, or a list of `n` responses when `n` is given.
+    """
+    async def __call__(self, messages: List[MessagesType], wait_for_connection: bool, n: Optional[int] = None) -> Union[str, List[str]]:
         pass
 
 
@@ -45,7 +66,7 @@ class MethodManager(ClassManager):
 
 
 class BaseMethod(ABC):
-    def __init__(self, input: str, output: str, global_rank:int, wait_for_model:bool, messages_list: List[MessagesType], unique_key, output_keys, output_types, random_extra_keys):
+    def __init__(self, input: str, output: str, global_rank:int, wait_for_model:bool, messages_list: List[MessagesType], unique_key, output_keys, output_types, random_extra_keys, variants: int = 1, variants_task: int = 0):
         self._default_unique_id = "_index"
         self.input = input
         self.output = output
@@ -56,34 +77,60 @@ class BaseMethod(ABC):
         self.output_types = output_types
         self.random_extra_keys = random_extra_keys
         self.messages_list = messages_list
-        self.replaceable_keys = [self._get_replaceable_keys(messages) for messages in self.messages_list]
+        self.variants = int(variants)
+        self.variants_task = int(variants_task)
+        # Templates are parsed once here instead of on every `str.format` call.
+        self._templates = [compile_messages(messages) for messages in self.messages_list]
+        self.replaceable_keys = [self._get_replaceable_keys(templates) for templates in self._templates]
+        # Input columns read by the templates, outputs of earlier tasks and extra keys are added while generating.
+        generated = set(self.output_keys) | set(self.random_extra_keys) | ({self.unique_key} if self.unique_key == self._default_unique_id else set())
+        self.template_columns = list(dict.fromkeys(key for templates in self._templates for template in templates
+                                                   for key in template.keys if key not in generated))
         self._detect_file_type(self.output)
         self._data = self.load_data(self.input)
         if self._default_unique_id == self.unique_key:
-            self._data[self.unique_key] = range(len(self._data))
-        
-        self._check_data(self._data, self.unique_key, self.output_keys, self.output_types, self.messages_list)
+            self._unique_ids = list(range(len(self._data)))
+        else:
+            self._unique_ids = self._data.column(self.unique_key) if self.unique_key in self._data.columns else []
+
+        self._check_data(self._data, self._unique_ids, self.unique_key, self.output_keys, self.output_types, self.messages_list)
+        if self.variants < 1 or not 0 <= self.variants_task < len(self.messages_list):
+            raise ValueError(f"'variants' must be at least 1 and 'variants_task' the index of a task, got {self.variants} and {self.variants_task}.")
         self._output_path_pattern, self._output_rank_path = self._generate_temporal_path(self.output, self.global_rank)
-        self._already_done = self.extract_unique_key_values(self._output_path_pattern, self.unique_key, self.global_rank)
+        self._writer = None
+        self._done_index = self.load_done_index(self._output_path_pattern, self.unique_key, self.global_rank, self._unique_ids, self.variants)
+        key_hashes = hash_keys(self._unique_ids)
+        if self.variants > 1:
+            # Every variant is an output record of its own, an input record is done once all of them are.
+            variant_ids = (self.variant_key(value, variant) for value in self._unique_ids for variant in range(self.variants))
+            self._variant_done = self._done_index.contains(hash_keys(variant_ids)).reshape(len(self._unique_ids), self.variants)
+            self._pending = ~self._variant_done.all(axis=1)
+        else:
+            self._variant_done = None
+            self._pending = ~self._done_index.contains(key_hashes)
+        self._stage_fingerprints = stage_fingerprints(self.messages_list, self.output_keys, self.output_types)
+        self._stages_path_pattern, self._stages_rank_path = self._generate_stages_path(self.output, self.global_rank)
+        self._checkpoints = self.load_checkpoints(self._stages_path_pattern, self.global_rank, DoneIndex(key_hashes[~self._pending]), self._stage_fingerprints)
+        self._stage_log = StageCheckpoints(self._stages_rank_path)
+        self._batch_keys = None
     
     @staticmethod
-    def _get_replaceable_keys(messages: MessagesType):
+    def _get_replaceable_keys(templates: List[CompiledTemplate]):
         keys = []
-        for msg in messages:
-            formatter = string.Formatter()
-            keys.extend([field_name for _, field_name, _, _ in formatter.parse(msg["content"]) if field_name])
+        for template in templates:
+            keys.extend(template.fields)
         return keys
 
     @staticmethod
-    def _check_data(df, unique_key, output_keys, output_types, messages_list):
-        existing_keys = [key for key in output_keys if key in df.columns]
+    def _check_data(reader: RecordReader, unique_ids, unique_key, output_keys, output_types, messages_list):
+        existing_keys = [key for key in output_keys if key in reader.columns]
         if existing_keys:
             raise KeyError(f"These keys '{str(existing_keys)}' already exists in dataset.")
         
-        if unique_key not in df.columns:
+        if len(unique_ids) != len(reader):
             raise ValueError(f"The unique key '{unique_key}' does not exist in the dataset.")
         
-        if not df[unique_key].is_unique:
+        if len(set(unique_ids)) != len(unique_ids):
             raise ValueError(f"The unique key '{unique_key}' exists but its values are not unique in the dataset.")
         
         not_permitted_types = set(output_types) - set(["json", "str"])
@@ -92,12 +139,28 @@ class BaseMethod(ABC):
 
         #TODO: Check messages format
 
-    def load_data(self, path):
-        return self._read_file(path)
+    def load_data(self, path) -> RecordReader:
+        """Opens the input lazily, records are only read when they are accessed."""
+        return open_reader(path, self._detect_file_type(path))
     
     def get_unique_id(self, index):
-        value = self._data.at[index, self.unique_key]
+        value = self._unique_ids[index]
         return int(value) if isinstance(value, np.integer) else value
+
+    @staticmethod
+    def variant_key(value, variant: int) -> str:
+        """Unique key of variant number `variant` generated from the input record with key `value`."""
+        return f"{value}_{variant}"
+
+    def get_variant_id(self, index, variant: int) -> str:
+        return self.variant_key(self.get_unique_id(index), variant)
+
+    def get_record(self, index, columns: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        """Returns the input record at `index` as a dict, with only `columns` when given."""
+        record = self._data.record(index, columns)
+        if self._default_unique_id == self.unique_key:
+            record[self.unique_key] = index
+        return record
     
     def get_extra_keys(self, index):
         new_data = {}
@@ -129,39 +192,162 @@ class BaseMethod(ABC):
             ValueError: If no changes were made after substitution.
         """
 
-        is_changed = False
-
-        def substitute_placeholders(template: str) -> str:
-            """Replaces placeholders using str.format(), raising an error if a key is missing."""
-            try:
-                text = template.format(**json_data)
-                return (text, True) if text != template else (text, False)
-            
-            except KeyError as e:
-                raise KeyError(f"Missing key in json_data: {e}. Please ensure that your input dataset contains all the required keys for the task.")
-
-        if 0 <= index < len(self.messages_list):
-            messages = self.messages_list[index]
-            new_messages = []
-            for msg in messages:
-                content, changed = substitute_placeholders(msg["content"])
-                new_messages.append({"role": msg["role"], "content": content})
-                is_changed = is_changed or changed
-        else:
+        if not 0 <= index < len(self._templates):
             raise IndexError("Invalid index: out of range.")
+        return self._render_task(index, json_data)
 
-        if not changed:
+    def _render_task(self, task: int, values: Dict[str, Any]) -> List[MessagesType]:
+        templates = self._templates[task]
+        try:
+            new_messages = [{"role": msg["role"], "content": template.render(values)} for msg, template in zip(self.messages_list[task], templates)]
+        except KeyError as e:
+            raise KeyError(f"Missing key in json_data: {e}. Please ensure that your input dataset contains all the required keys for the task.")
+
+        if templates[-1].static:
             raise ValueError("No substitutions made: The content is the same as before.")
-        
+
         return new_messages
 
+    def render_prompts(self, indices: Sequence[int], task: int = 0) -> List[List[MessagesType]]:
+        """Renders the messages of task `task` for every index in `indices` at once.
+
+        Only the columns the task references are read, as one list per column, so the
+        prompts of a whole shard can be built ahead of generation. Tasks that read the
+        output of an earlier task can only be rendered per record with `generate_messages`.
+
+        Raises:
+            KeyError: If the task references a key missing from the dataset.
+            IndexError: If task is out of range.
+            ValueError: If the task reads outputs of earlier tasks, or no changes were made after substitution.
+        """
+        if not 0 <= task < len(self._templates):
+            raise IndexError("Invalid index: out of range.")
+        keys = list(dict.fromkeys(key for template in self._templates[task] for key in template.keys))
+        outputs = [key for key in keys if key in self.output_keys]
+        if outputs:
+            raise ValueError(f"Task {task} reads the outputs {outputs} of earlier tasks, its prompts can only be rendered per record.")
+
+        indices = list(indices)
+        input_keys = [key for key in keys if key not in self.random_extra_keys and not (key == self._default_unique_id == self.unique_key)]
+        missing = [key for key in input_keys if key not in self._data.columns]
+        if missing:
+            raise KeyError(f"Missing key in json_data: {missing}. Please ensure that your input dataset contains all the required keys for the task.")
+        columns = self._data.take(indices, input_keys)
+        if self._default_unique_id == self.unique_key:
+            columns[self.unique_key] = indices
+        for key in keys:
+            if key in self.random_extra_keys:
+                values = self.random_extra_keys[key]
+                columns[key] = [values[index % len(values)] for index in indices]
+
+        return [self._render_task(task, {key: columns[key][row] for key in keys if key in columns}) for row in range(len(indices))]
+
     @abstractmethod
     def generate_data(self, index, get_llm_response: GetLLMResponseType):
         """Function to be implemented by subclasses"""
         pass
 
+    async def agenerate_data(self, index, aget_llm_response: AsyncGetLLMResponseType):
+        """Asynchronous variant of `generate_data`.
+
+        Methods that do not override it run `generate_data` in a worker thread, with
+        `aget_llm_response` bridged back to the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+
+        def get_llm_response(messages, wait_for_connection, n=None):
+            future = asyncio.run_coroutine_threadsafe(aget_llm_response(messages=messages, wait_for_connection=wait_for_connection, **({} if n is None else {"n": n})), loop)
+            return future.result()
+
+        return await asyncio.to_thread(self.generate_data, index, get_llm_response)
+
+    def init_record(self, index) -> Dict[str, Any]:
+        """Builds the working record for `index` before its first task runs. Used by the stage pipeline."""
+        raise NotImplementedError(f"Data method '{self.__class__.__name__}' does not support stage pipelining.")
+
+    async def agenerate_task(self, record: Dict[str, Any], task: int, index, aget_llm_response: AsyncGetLLMResponseType):
+        """Runs task `task` of `messages_list` on a working record and returns it, which may be a new object. Used by the stage pipeline."""
+        raise NotImplementedError(f"Data method '{self.__class__.__name__}' does not support stage pipelining.")
+
+    def finish_record(self, record: Dict[str, Any], index) -> Dict[str, Any]:
+        """Turns a working record into the output record once all tasks are done. Used by the stage pipeline."""
+        raise NotImplementedError(f"Data method '{self.__class__.__name__}' does not support stage pipelining.")
+
+    def request_args(self, task: int) -> Dict[str, Any]:
+        """Extra arguments of the model requests of task `task`: `n` for the task that fans out into variants."""
+        return {"n": self.variants} if self.variants > 1 and task == self.variants_task else {}
+
+    def batch_requests(self, indices: Sequence[int]) -> Iterator[Tuple[str, int, List[MessagesType], Dict[str, Any]]]:
+        """Yields the custom id, task, messages and request args of the first incomplete task of every record in `indices`. Used by the batch mode."""
+        raise NotImplementedError(f"Data method '{self.__class__.__name__}' does not support the batch mode.")
+
+    def apply_batch_response(self, index, task: int, response: Union[str, List[str]]):
+        """Sets the result of task `task` on record `index`, with one response per variant once the record fanned out.
+
+        Returns the output record after the last task, otherwise the task is checkpointed and None is returned. Used by the batch mode.
+        """
+        raise NotImplementedError(f"Data method '{self.__class__.__name__}' does not support the batch mode.")
+
+    def batch_id(self, index, task: int, variant: Optional[int] = None) -> str:
+        """Custom id of the batch request of task `task` for record `index`, or for one of its variants."""
+        return custom_id(self.get_unique_id(index) if variant is None else self.get_variant_id(index, variant), task)
+
+    def batch_target(self, value: str) -> Tuple[int, int, Optional[int]]:
+        """Returns the record index, task and variant (None for the whole record) of a batch custom id.
+
+        Raises:
+            KeyError: If the custom id does not belong to any input record.
+            ValueError: If the custom id is malformed.
+        """
+        key, task = parse_custom_id(value)
+        if self._batch_keys is None:
+            self._batch_keys = {str(value): (i, None) for i, value in enumerate(self._unique_ids)}, {}
+            if self.variants > 1:
+                self._batch_keys[1].update({self.variant_key(value, variant): (i, variant) for i, value in enumerate(self._unique_ids) for variant in range(self.variants)})
+        # Records are split into variants after the task that fans them out.
+        index, variant = self._batch_keys[1 if self.variants > 1 and task > self.variants_task else 0][key]
+        return index, task, variant
+
+    def mark_done(self, index):
+        """Marks record `index` as written, once all of its variants are."""
+        self._pending[index] = False
+        if self._variant_done is not None:
+            self._variant_done[index] = True
+
+    def reload_checkpoints(self):
+        """Reads the stage checkpoints again, including those this run appended."""
+        self._checkpoints = StageCheckpoints.load(sorted(glob.glob(self._stages_path_pattern)), self._stage_fingerprints)
+
     def is_done(self, index):
-        return self._data.at[index, self.unique_key] in self._already_done
+        return not self._pending[index]
+
+    def is_variant_done(self, index, variant: int) -> bool:
+        """Whether variant `variant` of record `index` was already written, when a record yields several variants."""
+        return self._variant_done is not None and bool(self._variant_done[index, variant])
+
+    def completed_stages(self, index) -> List[Dict[str, Any]]:
+        """Returns the keys added by each leading task of record `index` that an earlier run checkpointed."""
+        stages = self._checkpoints.get(key_hash(self.get_unique_id(index)))
+        completed = []
+        while stages and len(completed) in stages:
+            completed.append(stages[len(completed)])
+        return completed
+
+    def resume_stage(self, index) -> int:
+        """Returns the first task of record `index` that still has to run."""
+        return len(self.completed_stages(index)) if self._checkpoints else 0
+
+    def checkpoint_stage(self, stage: int, index, values: Dict[str, Any]):
+        """Saves the keys task `stage` added to record `index`, so a resumed run starts after it.
+
+        The last task is not checkpointed, the record is written to the shard instead.
+        """
+        if stage + 1 < len(self.messages_list):
+            self._stage_log.append(self.get_unique_id(index), stage, self._stage_fingerprints[stage], values)
+
+    def pending_indices(self):
+        """Returns the indices of the records that are not generated yet, in input order."""
+        return np.flatnonzero(self._pending).tolist()
 
     @staticmethod
     def _generate_temporal_path(path: str, number: int) -> str:
@@ -171,6 +357,13 @@ class BaseMethod(ABC):
         pattern = f"._{name}_*.jsonl"  # Insert number before extension
         return os.path.join(directory, pattern), os.path.join(directory, new_filename)  # Reconstruct full path
 
+    @staticmethod
+    def _generate_stages_path(path: str, number: int):
+        """Stage checkpoint files, named so they never match the pattern of the temporary shards."""
+        directory, filename = os.path.split(path)
+        name, _ = os.path.splitext(filename)
+        return os.path.join(directory, f"._{name}_*.stages"), os.path.join(directory, f"._{name}_{number}.stages")
+
 
     @staticmethod
     def _detect_file_type(path):
@@ -188,92 +381,156 @@ class BaseMethod(ABC):
             raise ValueError(f"Unsupported file format: {ext}")
     
     @staticmethod
-    def _read_file(path, file_type=None, cache=False, rank=0):
-        if not file_type:
-            file_type = BaseMethod._detect_file_type(path)
-        
-        """Reads a file and returns a Pandas DataFrame and its type."""
-        if file_type == "json":
-            df = pd.read_json(path)
-        elif file_type == "jsonl":
-            if cache and rank == 0:
+    def _repair_file(path):
+        """Drops the lines of a JSONL file that are not valid JSON, e.g. a line torn by a crash."""
+        temp_path = path + ".tmp"
+        with open(path, 'rb') as infile, open(temp_path, 'wb') as outfile:
+            for i, line in enumerate(infile, start=1):
                 try:
-                    df = pd.read_json(path, lines=True)
-                except:
-                    temp_path = path + ".tmp"
-                    with open(path, 'r') as infile, open(temp_path, 'w') as outfile:
-                        for i, line in enumerate(infile, start=1):
-                            try:
-                                json.loads(line)
-                                outfile.write(line)
-                            except json.JSONDecodeError as e:
-                                print(f"Skipping bad line {i}: {e}")
-                        os.replace(temp_path, path)
-            
-            torch.distributed.barrier()
-            df = pd.read_json(path, lines=True)
-        elif file_type == "csv":
-            df = pd.read_csv(path)
-        elif file_type == "parquet":
-            df = pd.read_parquet(path)
-        else:
-            raise ValueError(f"Unsupported file type: {file_type}")
+                    json.loads(line)
+                    # A last line without newline would be glued to the next appended record.
+                    outfile.write(line if line.endswith(b"\n") else line + b"\n")
+                except json.JSONDecodeError as e:
+                    print(f"Skipping bad line {i}: {e}")
+        os.replace(temp_path, path)
 
-        return df
-    
     @staticmethod
-    def _get_all_records(files_pattern):
-        files = sorted(glob.glob(files_pattern))  # Find all matching JSONL files
-        all_data = []
+    def load_done_index(file_pattern, key, rank, unique_ids, variants: int = 1) -> DoneIndex:
+        """Loads the keys already generated in the temporary shards matching `file_pattern`.
 
-        for file in files:
-            with open(file, "r", encoding="utf-8") as f:
-                all_data.extend(json.loads(line) for line in f)  # Load line-by-line
+        Rank 0 first recovers every shard to its last committed record and builds the
+        sidecar of any shard that has none, then every rank reads the sidecars.
+        """
+        file_paths = sorted(glob.glob(file_pattern))
+        if rank == 0:
+            index_of = None
+            for file_path in file_paths:
+                if os.path.exists(sidecar_path(file_path)):
+                    DoneIndex.recover(file_path)
+                else:
+                    if index_of is None:
+                        if variants > 1:
+                            index_of = {BaseMethod.variant_key(value, variant): i for i, value in enumerate(unique_ids) for variant in range(variants)}
+                        else:
+                            index_of = {str(value): i for i, value in enumerate(unique_ids)}
+                    BaseMethod._repair_file(file_path)
+                    DoneIndex.rebuild(file_path, key, index_of)
+
+        distributed.barrier()
+        return DoneIndex.load(file_paths)
 
-        return pd.DataFrame(all_data)
-    
     @staticmethod
-    def extract_unique_key_values(file_pattern, key, rank):
-        unique_values = set()  # To store unique values of the key
+    def load_checkpoints(file_pattern, rank, done_index: DoneIndex, fingerprints: List[str]):
+        """Loads the stage checkpoints of unfinished records from the files matching `file_pattern`.
 
-        # Get all file paths matching the pattern
-        file_paths = glob.glob(file_pattern)
-
-        for file_path in file_paths:
-            df = BaseMethod._read_file(file_path, cache=True, rank=rank)  # Read JSONL file into a DataFrame
-
-            # Add unique values from the current file to the set
-            if not df.empty:
-                unique_values.update(df[key].dropna().unique())
+        Rank 0 first compacts every file, dropping the checkpoints of records that are
+        done or whose tasks changed since they were written, then every rank reads them.
+        """
+        if rank == 0:
+            for file_path in sorted(glob.glob(file_pattern)):
+                StageCheckpoints.compact(file_path, done_index, fingerprints)
 
-        return unique_values 
+        distributed.barrier()
+        checkpoints = StageCheckpoints.load(sorted(glob.glob(file_pattern)), fingerprints)
+        if checkpoints:
+            logger.info(f"Found stage checkpoints of {len(checkpoints)} unfinished records.")
+        return checkpoints
 
     def set_record(self, record, index):
         """Append JSON line by line"""
         logger.debug(f"Setting record for field {index} in {self._output_rank_path}.")
-        with open(self._output_rank_path, "a", encoding="utf-8") as f:
-            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        payload = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        if self._writer is not None:
+            self._writer.write(record[self.unique_key], index, payload)
+        else:
+            DoneIndex.append(self._output_rank_path, record[self.unique_key], index, payload)
+
+    def open_writer(self, flush_interval: float = 1.0, flush_size: int = 64, fsync: str = "none"):
+        """Routes `set_record` through a background writer that group-commits records to the rank's shard."""
+        install_handlers()
+        self._writer = RecordWriter(self._output_rank_path, flush_interval, flush_size, fsync)
+
+    def close_writer(self):
+        """Writes every pending record and closes the background writer, if any."""
+        self._stage_log.close()
+        if self._writer is not None:
+            writer, self._writer = self._writer, None
+            writer.close()
+
+    def _get_part_paths(self, world_size):
+        """Part files written by each rank in the parallel finish mode."""
+        file_type = BaseMethod._detect_file_type(self.output)
+        if file_type == "parquet":
+            # Parquet parts form a dataset directory at the output path.
+            return [os.path.join(self.output, f"part-{rank:05d}.parquet") for rank in range(world_size)]
+        directory, filename = os.path.split(self.output)
+        name, _ = os.path.splitext(filename)
+        return [os.path.join(directory, f"._{name}.part-{rank:05d}.{file_type}") for rank in range(world_size)]
+
+    def save_part(self, rank, world_size):
+        """Writes this rank's part of the output in the parallel finish mode.
+
+        The input is split into one contiguous index range per rank, and each rank
+        merges the records of its range from all the temporary shards, so the parts
+        follow input order and can be joined without sorting. CSV columns and the
+        parquet schema are gathered from all ranks first, so every part matches.
+        """
+        file_type = BaseMethod._detect_file_type(self.output)
+        shard_paths = sorted(glob.glob(self._output_path_pattern))
+        start, end = utils.get_shard_range(len(self), rank, world_size)
+        index_range = (start, end if rank < world_size - 1 else None)
+
+        layouts = [None] * world_size
+        distributed.all_gather_object(layouts, collect_layout(shard_paths, file_type, index_range))
+        layout = merge_layouts(layouts, file_type)
+
+        if rank == 0 and file_type == "parquet":
+            os.makedirs(self.output, exist_ok=True)
+        distributed.barrier()
+        part_path = self._get_part_paths(world_size)[rank]
+        count = write_output(shard_paths, part_path, file_type, index_range=index_range, layout=layout, part=rank)
+        logger.info(f"Saved part {part_path} with {count} records.")
+
+    def merge_parts(self, world_size):
+        """Joins the parts written by `save_part` and removes the temporary shards, run by rank 0."""
+        file_type = BaseMethod._detect_file_type(self.output)
+        part_paths = self._get_part_paths(world_size)
+        if file_type == "parquet":
+            import pyarrow.parquet as pq
+            manifest = {
+                "format": "parquet",
+                "parts": [{"path": os.path.basename(path), "records": pq.ParquetFile(path).metadata.num_rows} for path in part_paths],
+            }
+            manifest["records"] = sum(part["records"] for part in manifest["parts"])
+            with open(os.path.join(self.output, "_manifest.json"), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=4)
+        else:
+            concatenate_parts(part_paths, self.output, file_type)
+            for path in part_paths:
+                os.remove(path)
+
+        self._remove_temporal_files()
+        logging.info(f"Saved: {self.output}")
+
+    def _remove_temporal_files(self):
+        for file in sorted(glob.glob(self._output_path_pattern)):
+            os.remove(file)
+            if os.path.exists(sidecar_path(file)):
+                os.remove(sidecar_path(file))
+        for file in sorted(glob.glob(self._stages_path_pattern)):
+            os.remove(file)
 
     def save_all(self):
+        """Merges every temporary shard into the output, in input order, and removes the shards."""
         file_type = BaseMethod._detect_file_type(self.output)
-        df = BaseMethod._get_all_records(self._output_path_pattern)
-    
-        if file_type == "json":
-            df.to_json(self.output, orient="records", indent=4)
-        elif file_type == "jsonl":
-            df.to_json(self.output, orient="records", lines=True)
-        elif file_type == "csv":
-            df.to_csv(self.output, index=False)
-        elif file_type == "parquet":
-            df.to_parquet(self.output, index=False)
-        
-        [os.remove(file) for file in sorted(glob.glob(self._output_path_pattern))]
+        write_output(sorted(glob.glob(self._output_path_pattern)), self.output, file_type)
+        self._remove_temporal_files()
         logging.info(f"Saved: {self.output}")
 
     def __len__(self):
         return len(self._data)
 
     def __getitem__(self, index):
-        self._data[index]
+        return self.get_record(index)
 
 
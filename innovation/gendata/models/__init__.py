@@ -1 +1,3 @@
-from .open_ai import OpenAI
\ No newline at end of file
+from .open_ai import OpenAIChat
+from .open_ai_balanced import BalancedOpenAIChat
+from .local import LocalChat
\ No newline at end of file
@@ -0,0 +1,117 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional
+from innovation.gendata.utils.logger import setup_logger
+from innovation.gendata.utils.metrics import metrics
+
+logger = setup_logger(__name__)
+
+
+class _Request:
+    __slots__ = ("item", "rows", "future", "arrival")
+
+    def __init__(self, item, rows: int):
+        self.item = item
+        self.rows = rows
+        self.future = Future()
+        self.arrival = time.monotonic()
+
+
+class DynamicBatcher:
+    """Groups requests submitted from many threads or coroutines into batches run by one worker thread.
+
+    A batch starts with the oldest waiting request and takes the next ones until it
+    holds `max_batch_size` rows or `max_wait` seconds have passed since that request
+    arrived. A lone request therefore waits at most `max_wait`, while a busy queue is
+    drained in full batches. A request of several rows is never split across batches.
+
+    Args:
+        run_batch (callable): Runs a list of items and returns one result per item, in order.
+        max_batch_size (int): Rows per batch.
+        max_wait (float): Seconds the oldest request waits for others to join its batch.
+        name (str): Name of the worker thread.
+    """
+
+    def __init__(self, run_batch: Callable[[List[Any]], List[Any]], max_batch_size: int = 8, max_wait: float = 0.01, name: str = "DynamicBatcher"):
+        self.max_batch_size = int(max_batch_size)
+        self.max_wait = float(max_wait)
+        self._run_batch = run_batch
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        # A request that did not fit in the previous batch opens the next one.
+        self._carry: Optional[_Request] = None
+        self._closed = False
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def config(self):
+        return {"max_batch_size": self.max_batch_size, "max_wait": self.max_wait}
+
+    def submit(self, item, rows: int = 1) -> Future:
+        """Queues `item`, taking `rows` rows of a batch, and returns the future of its result."""
+        if self._closed:
+            raise RuntimeError("The batcher is closed.")
+        request = _Request(item, rows)
+        self._queue.put(request)
+        return request.future
+
+    def _collect(self) -> Optional[List[_Request]]:
+        first, self._carry = self._carry or self._queue.get(), None
+        if first is None:
+            return None
+        batch, rows = [first], first.rows
+        deadline = first.arrival + self.max_wait
+        while rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                request = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Closing, the sentinel ends the loop after this batch.
+                self._queue.put(None)
+                break
+            if rows + request.rows > self.max_batch_size:
+                self._carry = request
+                break
+            batch.append(request)
+            rows += request.rows
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            # Requests cancelled while waiting, e.g. by a cancelled coroutine, are dropped.
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            rows = sum(request.rows for request in batch)
+            metrics.observe("batch_rows", rows)
+            self.requests += len(batch)
+            self.rows += rows
+            self.batches += 1
+            try:
+                results = self._run_batch([request.item for request in batch])
+            except BaseException as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+
+    def close(self):
+        """Runs the requests already queued and stops the worker thread."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
+
+    def log_stats(self, label: str):
+        if self.batches:
+            logger.info(f"{label}: {self.requests} requests in {self.batches} batches, {self.rows / self.batches:.1f} rows per batch on average.")
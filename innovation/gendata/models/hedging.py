@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable
+import numpy as np
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class HedgePolicy:
+    """Decides when a slow request gets a duplicate, and keeps the extra load within budget.
+
+    A duplicate is sent once a request has been running longer than the `percentile`
+    of the latencies observed so far (over the last `window` requests, after at least
+    `min_samples`), as long as duplicates stay below `max_extra_load` percent of all requests.
+
+    Args:
+        percentile (float): Latency percentile after which a request is hedged.
+        max_extra_load (float): Maximum duplicates, as a percentage of the requests.
+        min_samples (int): Requests observed before hedging starts.
+        window (int): Number of recent latencies the percentile is computed over.
+    """
+
+    def __init__(self, percentile: float = 95, max_extra_load: float = 5, min_samples: int = 20, window: int = 1000):
+        self.percentile = percentile
+        self.max_extra_load = max_extra_load
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def delay(self):
+        """Seconds after which a request should be hedged, or None while there are too few samples."""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            return float(np.percentile(self._latencies, self.percentile))
+
+    def try_hedge(self) -> bool:
+        """Takes one duplicate from the budget, if there is any left."""
+        with self._lock:
+            if self.hedges + 1 > self.max_extra_load / 100 * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def observe(self, latency: float, hedge_won: bool = False):
+        with self._lock:
+            self.requests += 1
+            self.hedge_wins += hedge_won
+            self._latencies.append(latency)
+
+    def config(self):
+        return {"percentile": self.percentile, "max_extra_load": self.max_extra_load, "min_samples": self.min_samples, "window": self._latencies.maxlen}
+
+    def log_stats(self, name: str):
+        logger.info(f"Hedging ({name}): {self.hedges} duplicates for {self.requests} requests, {self.hedge_wins} returned first.")
+
+
+async def run_hedged(policy: HedgePolicy, attempt: Callable[[int], Awaitable]):
+    """Awaits `attempt(0)` and, if it is slower than the policy allows, also `attempt(1)`.
+
+    The first attempt to succeed wins and the other one is cancelled. If one attempt
+    fails the other is still awaited, and the error is only raised if both fail.
+    """
+    start = time.monotonic()
+    tasks = [asyncio.ensure_future(attempt(0))]
+    try:
+        delay = policy.delay()
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done and policy.try_hedge():
+            logger.debug(f"Request running for more than {delay:.2f}s, sending a duplicate.")
+            tasks.append(asyncio.ensure_future(attempt(1)))
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    policy.observe(time.monotonic() - start, hedge_won=task is not tasks[0])
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,149 @@
+import asyncio
+import importlib.util
+import time
+from innovation.gendata.models.model_manager import ModelManager, BaseModel
+from innovation.gendata.models.batching import DynamicBatcher
+from innovation.gendata.models.open_ai import TokenLimitError
+from innovation.gendata.utils.logger import setup_logger
+from innovation.gendata.utils.metrics import metrics
+
+logger = setup_logger(__name__)
+
+# Model params understood by the local backend, anything else is meant for an HTTP API.
+GENERATION_PARAMS = {"max_tokens", "temperature", "top_p", "top_k", "repetition_penalty", "seed"}
+
+
+@ModelManager.register("local")
+class LocalChat(BaseModel):
+    """Chat model loaded in the process with Hugging Face transformers, without a server.
+
+    Concurrent requests, from `--concurrency` or `--pipeline`, are grouped into
+    batches by a `DynamicBatcher` and generated with a single padded `generate` call,
+    so one process keeps all CPU cores busy instead of generating one prompt at a
+    time. A batch is sent once it holds `max_batch_size` sequences or its first
+    request has waited `max_wait` seconds. A request for `n` completions takes `n`
+    sequences of its batch.
+
+    Args:
+        model (str): Hugging Face model name or path, the model needs a chat template.
+        max_batch_size (int): Sequences generated together.
+        max_wait (float): Seconds a request waits for others to fill its batch.
+        device (str): Torch device the model runs on.
+        dtype (str): Torch dtype of the weights, e.g. `bfloat16`, or `auto` for the checkpoint's.
+        threads (int, optional): Torch intra-op threads, by default torch's choice.
+        model_params (dict): `max_tokens`, `temperature`, `top_p`, `top_k`, `repetition_penalty` and `seed`.
+    """
+
+    def __init__(self, model=None, max_batch_size=8, max_wait=0.01, device="cpu", dtype="float32", threads=None, model_params={}):
+        if not model:
+            raise ValueError("The local backend requires a model name or path, e.g. --model-args model=Qwen/Qwen2.5-0.5B-Instruct.")
+        if importlib.util.find_spec("transformers") is None:
+            raise ImportError("The local backend requires the 'transformers' package, install it with `pip install transformers`.")
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.model = model
+        self.device = device
+        self.dtype = dtype
+        self.threads = int(threads) if threads else None
+        if self.threads:
+            torch.set_num_threads(self.threads)
+
+        unsupported = sorted(set(model_params) - GENERATION_PARAMS)
+        if unsupported:
+            logger.warning(f"Ignoring model params not used by the local backend: {', '.join(unsupported)}.")
+        default_params = {"max_tokens": 1000, "temperature": 0.2}
+        self.model_params = self._get_params({key: value for key, value in model_params.items() if key in GENERATION_PARAMS}, default_params)
+
+        self._torch = torch
+        self._tokenizer = AutoTokenizer.from_pretrained(model)
+        if not getattr(self._tokenizer, "chat_template", None):
+            raise ValueError(f"The tokenizer of '{model}' has no chat template.")
+        # Prompts of a batch are padded on the left so every sequence continues from its last token.
+        self._tokenizer.padding_side = "left"
+        if self._tokenizer.pad_token_id is None:
+            self._tokenizer.pad_token = self._tokenizer.eos_token
+        self._model = AutoModelForCausalLM.from_pretrained(model, torch_dtype=dtype if dtype == "auto" else getattr(torch, dtype))
+        self._model.to(device)
+        self._model.eval()
+        eos = self._model.generation_config.eos_token_id
+        self._eos_ids = torch.tensor(eos if isinstance(eos, list) else [eos if eos is not None else self._tokenizer.eos_token_id], device=device)
+
+        self._batcher = DynamicBatcher(self._run_batch, max_batch_size, max_wait, name="LocalBatcher")
+        self.batching = self._batcher.config()
+
+    def get_model_name(self):
+        return self.model
+
+    def _generate_kwargs(self):
+        params = self.model_params
+        kwargs = {"max_new_tokens": int(params["max_tokens"]), "pad_token_id": self._tokenizer.pad_token_id}
+        temperature = float(params.get("temperature") or 0)
+        if temperature > 0:
+            kwargs.update(do_sample=True, temperature=temperature)
+            if params.get("top_p") is not None:
+                kwargs["top_p"] = float(params["top_p"])
+            if params.get("top_k") is not None:
+                kwargs["top_k"] = int(params["top_k"])
+        else:
+            kwargs["do_sample"] = False
+        if params.get("repetition_penalty") is not None:
+            kwargs["repetition_penalty"] = float(params["repetition_penalty"])
+        return kwargs
+
+    def _run_batch(self, items):
+        """Generates the requests `(messages, n)` of a batch, returning per request its prompt tokens and
+        `(content, finish_reason, completion_tokens)` of each completion."""
+        torch = self._torch
+        prompts, owners = [], []
+        for position, (messages, n) in enumerate(items):
+            prompt = self._tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            prompts.extend([prompt] * (n or 1))
+            owners.extend([position] * (n or 1))
+        # The chat template already holds the special tokens of the prompt.
+        inputs = self._tokenizer(prompts, return_tensors="pt", padding=True, add_special_tokens=False).to(self.device)
+        if self.model_params.get("seed") is not None:
+            torch.manual_seed(int(self.model_params["seed"]))
+        with torch.inference_mode():
+            output = self._model.generate(**inputs, **self._generate_kwargs())
+        generated = output[:, inputs["input_ids"].shape[1]:]
+        prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+
+        results = [(0, []) for _ in items]
+        for row, position in enumerate(owners):
+            tokens = generated[row]
+            ends = torch.nonzero(torch.isin(tokens, self._eos_ids)).flatten()
+            # A sequence without end of sequence token was cut by `max_tokens`.
+            length, finish_reason = (int(ends[0]) + 1, "stop") if len(ends) else (len(tokens), "length")
+            content = self._tokenizer.decode(tokens[:length], skip_special_tokens=True)
+            results[position] = (prompt_tokens[row], results[position][1] + [(content, finish_reason, length)])
+        return results
+
+    def _get_content(self, result, n=None):
+        prompt_tokens, completions = result
+        metrics.observe("prompt_tokens", prompt_tokens)
+        metrics.observe("completion_tokens", sum(length for _, _, length in completions))
+        if any(finish_reason == "length" for _, finish_reason, _ in completions):
+            error_msg = (
+                f"Failed to generate response: the `max_tokens` value is too low. "
+                f"Current setting: {self.model_params['max_tokens']}. Please increase it."
+            )
+            logger.error(f"Local model: {error_msg}")
+            raise TokenLimitError(error_msg)
+        contents = [content for content, _, _ in completions]
+        return contents if n is not None else contents[0]
+
+    def get_response(self, messages, wait_for_connection=False, n=None):
+        start = time.monotonic()
+        result = self._batcher.submit((messages, n), rows=n or 1).result()
+        metrics.observe("request_latency_seconds", time.monotonic() - start)
+        return self._get_content(result, n)
+
+    async def aget_response(self, messages, wait_for_connection=False, n=None):
+        start = time.monotonic()
+        result = await asyncio.wrap_future(self._batcher.submit((messages, n), rows=n or 1))
+        metrics.observe("request_latency_seconds", time.monotonic() - start)
+        return self._get_content(result, n)
+
+    def log_stats(self):
+        self._batcher.log_stats(f"Local model {self.model}")
@@ -1,4 +1,6 @@
 from abc import ABC, abstractmethod
+import asyncio
+import inspect
 import logging
 from innovation.gendata.utils.class_manager import ClassManager
 from innovation.gendata.utils.logger import setup_logger
@@ -14,6 +16,16 @@ class ModelManager(ClassManager):
     registered_classes: dict[str, Type] = {}
 
 
+def n_kwargs(n):
+    """Keyword arguments passing `n` to a backend, empty for a single completion so backends without `n` keep working."""
+    return {} if n is None else {"n": n}
+
+
+def _accepts_n(method) -> bool:
+    parameters = inspect.signature(method).parameters.values()
+    return any(p.name == "n" or p.kind is inspect.Parameter.VAR_KEYWORD for p in parameters)
+
+
 class BaseModel(ABC):
     def __init__(self):
         pass
@@ -38,7 +50,36 @@ class BaseModel(ABC):
         logger.info("Namespace:\n%s", pformat(vars(SimpleNamespace(**attr))))
 
     @abstractmethod
-    def get_response(self, messages, wait_for_connection=False):
-        """Function to be implemented by subclasses"""
+    def get_response(self, messages, wait_for_connection=False, n=None):
+        """Function to be implemented by subclasses.
+
+        With `n`, a list of `n` completions of the same prompt is returned instead of a single one.
+        """
         pass
 
+    async def aget_response(self, messages, wait_for_connection=False, n=None):
+        """Asynchronous variant of `get_response`.
+
+        Backends without a native async client run `get_response` in a worker thread.
+        """
+        return await asyncio.to_thread(self.get_response, messages, wait_for_connection, **n_kwargs(n))
+
+    def supports_n(self) -> bool:
+        """Whether `get_response` and `aget_response` accept `n`, which tasks with `variants` need."""
+        return _accepts_n(self.get_response) and _accepts_n(self.aget_response)
+
+    def batch_body(self, messages, n=None):
+        """Body of an OpenAI Batch request for `messages`, as `get_response` would send it. Used by the batch mode."""
+        raise NotImplementedError(f"Model API '{self.__class__.__name__}' does not support the batch mode.")
+
+    def parse_batch_response(self, body, n=None):
+        """Content of the completion `body` of a batch result, as `get_response` would return it. Used by the batch mode."""
+        raise NotImplementedError(f"Model API '{self.__class__.__name__}' does not support the batch mode.")
+
+    async def aclose(self):
+        """Release resources held by the asynchronous client, if any."""
+        pass
+
+    def log_stats(self):
+        """Log backend statistics at the end of the generation, if any."""
+        pass
@@ -1,10 +1,20 @@
 from innovation.gendata.models.model_manager import ModelManager, BaseModel
-from openai import OpenAI
+from innovation.gendata.models.rate_limiter import RateController
+from innovation.gendata.models.hedging import HedgePolicy, run_hedged
+from innovation.gendata.models.transport import HTTPTransport
+from innovation.gendata.models.streaming import EarlyStop, StreamStats
+from innovation.gendata.models.token_budget import TokenBudget
 from innovation.gendata.utils.logger import setup_logger
+from innovation.gendata.utils.metrics import metrics
+import asyncio
 import time
 
 logger = setup_logger(__name__)
 
+# Statuses worth retrying, and those that mean the server is overloaded and should get fewer requests.
+RETRY_STATUS = {408, 409, 429}
+OVERLOAD_STATUS = {429, 502, 503, 504}
+
 class TokenLimitError(Exception):
     pass
 
@@ -14,39 +24,276 @@ class OpenAIChat(BaseModel):
         self.api_url = api_url
         self.model = model
         self._api_key = api_key
-        self._client = OpenAI(base_url=self.api_url, api_key=api_key)
+        # openai is imported when a client is built, so commands that never call a model start fast.
+        from openai import OpenAI, AsyncOpenAI
+        model_params = dict(model_params)
+        self._transport = HTTPTransport.shared(**(model_params.pop("transport", None) or {}))
+        self.transport = self._transport.config()
+        # Retries are handled by the rate controller, which shares its backoff between requests.
+        self._client = OpenAI(base_url=self.api_url, api_key=api_key, max_retries=0, http_client=self._transport.client())
+        self._async_client = AsyncOpenAI(base_url=self.api_url, api_key=api_key, max_retries=0, http_client=self._transport.async_client())
+
+        self._controller = RateController(**(model_params.pop("rate_limit", None) or {}))
+        self.rate_limit = self._controller.config()
+        hedge = model_params.pop("hedge", None)
+        self._hedge = HedgePolicy(**hedge) if hedge else None
+        self.hedge = self._hedge.config() if self._hedge else None
+        self.stream = bool(model_params.pop("stream", False))
+        early_stop = model_params.pop("early_stop", None)
+        if early_stop and not self.stream:
+            raise ValueError("'early_stop' in model-params requires 'stream: true'.")
+        self._early_stop = EarlyStop(**(early_stop or {}))
+        self.early_stop = self._early_stop.config() if early_stop else None
+        self._stream_stats = StreamStats()
+        token_budget = model_params.pop("token_budget", None)
+        self._budget = TokenBudget(**token_budget) if token_budget else None
+        self.token_budget = self._budget.config() if self._budget else None
 
         default_params = { "max_tokens": 5000, "temperature": 0.2}
-        self.model_params = self._get_params(model_params, default_params, {"model", "messages", "stream", "api_key", "api_url"})
+        self.model_params = self._get_params(model_params, default_params, {"model", "messages", "api_key", "api_url"})
 
     def get_model_name(self):
         return self.model
 
-    def get_response(self, messages, wait_for_connection=False):
-        params = {"model": self.model, "messages": messages, "stream": False}
+    def _get_request_params(self, messages, n=None):
+        # Several completions are requested without streaming, the stream reader follows a single choice.
+        params = {"model": self.model, "messages": messages, "stream": self.stream and n is None}
         params.update(self.model_params)
-        first = True
-        while wait_for_connection or first:
+        if n is not None:
+            params["n"] = n
+        return params
+
+    def _get_content(self, response, max_tokens=None):
+        content, finish_reason, _, _ = response
+        if finish_reason == 'length':
+            error_msg = (
+                f"Failed to generate response: the `max_tokens` value is too low. "
+                f"Current setting: {max_tokens or self.model_params.get('max_tokens')}. Please increase it."
+            )
+            raise TokenLimitError(error_msg)
+        if finish_reason == 'max_chars':
+            raise TokenLimitError(f"Failed to generate response: the output exceeded `early_stop.max_chars` ({self._early_stop.max_chars}).")
+        return content
+
+    @classmethod
+    def _unpack(cls, response, n=None):
+        """Returns the content, finish reason, total tokens and completion tokens of a completion.
+
+        With `n`, the content is the list of all choices, and the finish reason is `length` if any of them was cut.
+        """
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            metrics.observe("prompt_tokens", usage.prompt_tokens or 0)
+            metrics.observe("completion_tokens", usage.completion_tokens or 0)
+        if n is None:
+            return (response.choices[0].message.content, response.choices[0].finish_reason, cls._used_tokens(response),
+                    getattr(usage, "completion_tokens", None))
+        choices = sorted(response.choices, key=lambda choice: choice.index)
+        if len(choices) != n:
+            raise ValueError(f"Requested {n} completions but the server returned {len(choices)}.")
+        finish_reason = "length" if any(choice.finish_reason == "length" for choice in choices) else choices[0].finish_reason
+        return [choice.message.content for choice in choices], finish_reason, cls._used_tokens(response), getattr(usage, "completion_tokens", None)
+
+    def _on_chunk(self, chunk, scanner, chunk_times):
+        """Handles one streamed chunk, returns the finish reason once the response is complete."""
+        if not chunk.choices:
+            return None
+        choice = chunk.choices[0]
+        if choice.delta is not None and choice.delta.content:
+            chunk_times.append(time.monotonic())
+            reason = scanner.feed(choice.delta.content)
+            if reason is not None:
+                return reason
+        return choice.finish_reason
+
+    def _read_stream(self, stream, start):
+        scanner, chunk_times, finish_reason = self._early_stop.scanner(), [], None
+        try:
+            for chunk in stream:
+                finish_reason = self._on_chunk(chunk, scanner, chunk_times) or finish_reason
+                if finish_reason is not None:
+                    break
+        finally:
+            # Closing the stream before the server is done aborts the generation.
+            stream.close()
+        self._stream_stats.observe(start, chunk_times, finish_reason)
+        return scanner.content, finish_reason, None, None
+
+    async def _aread_stream(self, stream, start):
+        scanner, chunk_times, finish_reason = self._early_stop.scanner(), [], None
+        try:
+            async for chunk in stream:
+                finish_reason = self._on_chunk(chunk, scanner, chunk_times) or finish_reason
+                if finish_reason is not None:
+                    break
+        finally:
+            await stream.close()
+        self._stream_stats.observe(start, chunk_times, finish_reason)
+        return scanner.content, finish_reason, None, None
+
+    def _plan_budget(self, messages, params):
+        """Sets `max_tokens` of the request from the token budget, if any, and returns the prompt tokens."""
+        if self._budget is None:
+            return None
+        prompt_tokens, params["max_tokens"] = self._budget.plan(messages, params.get("max_tokens"))
+        return prompt_tokens
+
+    def _retry_length(self, response, params, prompt_tokens, retry):
+        """Returns whether to retry a response cut by the token budget, raising its `max_tokens` if so.
+
+        The output length of any other response is recorded for the budget of its stage.
+        """
+        if self._budget is None:
+            return False
+        content, finish_reason, _, completion_tokens = response
+        if finish_reason != "length":
+            if finish_reason == "max_chars":
+                return False
+            if isinstance(content, list):
+                # The usage of several choices is a total, each of them is counted as an equal share.
+                for text in content:
+                    self._budget.observe(text, completion_tokens // len(content) if completion_tokens is not None else None)
+            else:
+                self._budget.observe(content, completion_tokens)
+            return False
+        budget = self._budget.grow(prompt_tokens, params["max_tokens"], retry)
+        if budget is None:
+            return False
+        logger.warning(f"Response cut at max_tokens={params['max_tokens']}, retrying with max_tokens={budget}.")
+        params["max_tokens"] = budget
+        return True
+
+    def _estimate_tokens(self, params):
+        # Rough count for the tokens-per-minute budget: about 4 characters per prompt token plus the completion budget of every choice.
+        prompt_chars = sum(len(str(message.get("content", ""))) for message in params["messages"])
+        return prompt_chars // 4 + int(params.get("max_tokens") or 0) * int(params.get("n") or 1)
+
+    @staticmethod
+    def _used_tokens(response):
+        usage = getattr(response, "usage", None)
+        return getattr(usage, "total_tokens", None)
+
+    @staticmethod
+    def _classify_error(err):
+        """Returns whether `err` is worth retrying, whether it signals overload and the server's `Retry-After`."""
+        from openai import APIConnectionError, APIStatusError, APITimeoutError
+        retry_after = None
+        response = getattr(err, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        if isinstance(err, APITimeoutError):
+            return True, True, retry_after
+        if isinstance(err, APIConnectionError):
+            return True, False, retry_after
+        if isinstance(err, APIStatusError):
+            status = err.status_code
+            return status in RETRY_STATUS or status >= 500, status in OVERLOAD_STATUS, retry_after
+        return False, False, retry_after
+
+    def _on_error(self, err, attempt, tokens, latency, wait_for_connection):
+        """Releases the failed request's slot and returns the delay before retrying, or raises `err`."""
+        retriable, overload, retry_after = self._classify_error(err)
+        self._controller.release(tokens, 0, latency, overload=overload, retry_after=retry_after)
+        metrics.inc("request_errors_total")
+        # With --wait-for-model every error is retried, e.g. a 404 while the server is still loading its model.
+        if not wait_for_connection and (not retriable or attempt >= self._controller.max_retries):
+            logger.error(f"Openai API {err}")
+            raise err
+        delay = self._controller.backoff(attempt, retry_after)
+        metrics.inc("retries_total")
+        logger.warning(f"Openai API {err}. Retrying in {delay:.1f}s (attempt {attempt + 1}).")
+        return delay
+
+    def get_response(self, messages, wait_for_connection=False, n=None):
+        params = self._get_request_params(messages, n)
+        prompt_tokens = self._plan_budget(messages, params)
+        tokens = self._estimate_tokens(params)
+        attempt = length_retries = 0
+        while True:
+            wait_start = time.monotonic()
+            self._controller.acquire(tokens)
+            start = time.monotonic()
+            metrics.observe("rate_limit_wait_seconds", start - wait_start)
             try:
-                first = False
                 logger.debug("Calling chat.completions.create()")
                 response = self._client.chat.completions.create(**params)
-                if response.choices[0].finish_reason == 'length':
-                    error_msg = (
-                        f"Failed to generate response: the `max_tokens` value is too low. "
-                        f"Current setting: {self.model_params.get('max_tokens')}. Please increase it."
-                    )
-                    raise TokenLimitError(error_msg)
-                return response.choices[0].message.content
-            
+                response = self._read_stream(response, start) if params["stream"] else self._unpack(response, n)
+            except Exception as err:
+                time.sleep(self._on_error(err, attempt, tokens, time.monotonic() - start, wait_for_connection))
+                attempt += 1
+                continue
+            self._controller.release(tokens, response[2], time.monotonic() - start)
+            metrics.observe("request_latency_seconds", time.monotonic() - start)
+            if self._retry_length(response, params, prompt_tokens, length_retries):
+                length_retries += 1
+                tokens = self._estimate_tokens(params)
+                continue
+            try:
+                return self._get_content(response, params.get("max_tokens"))
             except TokenLimitError as err:
                 logger.error(f"OpenAI API: {err}")
                 raise
+
+    async def aget_response(self, messages, wait_for_connection=False, n=None):
+        if self._hedge is None:
+            return await self._aget_response(messages, wait_for_connection, n)
+        # The duplicate is sent on another connection of the same client pool.
+        return await run_hedged(self._hedge, lambda _: self._aget_response(messages, wait_for_connection, n))
+
+    async def _aget_response(self, messages, wait_for_connection=False, n=None):
+        params = self._get_request_params(messages, n)
+        prompt_tokens = self._plan_budget(messages, params)
+        tokens = self._estimate_tokens(params)
+        attempt = length_retries = 0
+        while True:
+            wait_start = time.monotonic()
+            await self._controller.aacquire(tokens)
+            start = time.monotonic()
+            metrics.observe("rate_limit_wait_seconds", start - wait_start)
+            try:
+                logger.debug("Calling async chat.completions.create()")
+                response = await self._async_client.chat.completions.create(**params)
+                response = await self._aread_stream(response, start) if params["stream"] else self._unpack(response, n)
+            except asyncio.CancelledError:
+                self._controller.release(tokens, 0, time.monotonic() - start)
+                raise
             except Exception as err:
-                msg = ". Waiting for connection to be established..." if wait_for_connection else ""
-                logger.error(f"Openai API {err}{msg}")
-                if not wait_for_connection:
-                    raise err
-                else:
-                    time.sleep(60)
+                await asyncio.sleep(self._on_error(err, attempt, tokens, time.monotonic() - start, wait_for_connection))
+                attempt += 1
+                continue
+            self._controller.release(tokens, response[2], time.monotonic() - start)
+            metrics.observe("request_latency_seconds", time.monotonic() - start)
+            if self._retry_length(response, params, prompt_tokens, length_retries):
+                length_retries += 1
+                tokens = self._estimate_tokens(params)
+                continue
+            try:
+                return self._get_content(response, params.get("max_tokens"))
+            except TokenLimitError as err:
+                logger.error(f"OpenAI API: {err}")
+                raise
+
+    def batch_body(self, messages, n=None):
+        params = self._get_request_params(messages, n)
+        # Batch runners answer with complete responses, `max_tokens` comes from the token budget like a live request.
+        params.pop("stream")
+        self._plan_budget(messages, params)
+        return params
+
+    def parse_batch_response(self, body, n=None):
+        from openai.types.chat import ChatCompletion
+        return self._get_content(self._unpack(ChatCompletion.model_validate(body), n))
+
+    async def aclose(self):
+        await self._async_client.close()
 
+    def log_stats(self):
+        self._transport.log_stats()
+        self._stream_stats.log_stats()
+        if self._hedge is not None:
+            self._hedge.log_stats(self.api_url)
+        if self._budget is not None:
+            self._budget.log_stats()
@@ -0,0 +1,213 @@
+from innovation.gendata.models.model_manager import ModelManager, BaseModel
+from innovation.gendata.models.open_ai import OpenAIChat, TokenLimitError
+from innovation.gendata.models.hedging import HedgePolicy, run_hedged
+from innovation.gendata.models.token_budget import TokenBudget
+from innovation.gendata.utils.logger import setup_logger
+import asyncio
+import itertools
+import os
+import threading
+import time
+
+logger = setup_logger(__name__)
+
+
+class _Endpoint:
+    """One replica behind the balancer, with its client and health state."""
+
+    def __init__(self, chat: OpenAIChat):
+        self.chat = chat
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.requests = 0
+        self.errors = 0
+        self.latency = 0.0
+
+    def stats(self):
+        return {"healthy": self.healthy, "outstanding": self.outstanding, "requests": self.requests, "errors": self.errors,
+                "mean_latency": self.latency / self.requests if self.requests else None}
+
+
+@ModelManager.register("openai_balanced")
+class BalancedOpenAIChat(BaseModel):
+    """OpenAI-compatible backend spread over several replicas of the same model.
+
+    Every request goes to the healthy replica with the fewest outstanding requests.
+    A replica is ejected after `eject_after` consecutive failed requests or health
+    probes, and reinstated once a probe to its `models` endpoint succeeds again.
+    Failed requests are retried on another replica. `api_urls` is separated by `|`
+    since `--model-args` pairs are separated by commas.
+    """
+
+    def __init__(self, api_urls="http://localhost:8080/v1/", api_key="xyz", model="tgi", model_params={}, probe_interval=10, eject_after=3):
+        self.api_urls = [url.strip() for url in api_urls.split("|") if url.strip()]
+        if not self.api_urls:
+            raise ValueError("At least one url is required in api_urls.")
+        self.model = model
+        self.probe_interval = float(probe_interval)
+        self.eject_after = int(eject_after)
+        # Hedging is done across replicas by the balancer rather than by each replica's client.
+        model_params = dict(model_params)
+        hedge = model_params.pop("hedge", None)
+        self._hedge = HedgePolicy(**hedge) if hedge else None
+        self.hedge = self._hedge.config() if self._hedge else None
+        # One token budget learns the output lengths of all replicas, and the tokenizer is loaded once.
+        token_budget = model_params.pop("token_budget", None)
+        self._endpoints = [_Endpoint(OpenAIChat(url, api_key, model, model_params)) for url in self.api_urls]
+        self._budget = TokenBudget(**token_budget) if token_budget else None
+        self.token_budget = self._budget.config() if self._budget else None
+        for endpoint in self._endpoints:
+            endpoint.chat._budget = self._budget
+        self.model_params = self._endpoints[0].chat.model_params
+        self.rate_limit = self._endpoints[0].chat.rate_limit
+        self.transport = self._endpoints[0].chat.transport
+        # Replicas share the connection pools of a single transport.
+        self._transport = self._endpoints[0].chat._transport
+        # Retries move to the balancer so a failing request goes to another replica instead of waiting on the same one.
+        self._max_retries = self.rate_limit["max_retries"]
+        for endpoint in self._endpoints:
+            endpoint.chat._controller.max_retries = 0
+        # Ranks start their round-robin at different replicas so equal loads are spread out.
+        self._next = int(os.environ.get("RANK", 0))
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._prober = threading.Thread(target=self._probe_loop, name="HealthProbe", daemon=True)
+        self._prober.start()
+
+    def get_model_name(self):
+        return self.model
+
+    def _acquire(self, exclude=()):
+        with self._lock:
+            candidates = [e for e in self._endpoints if e.healthy and e not in exclude]
+            if not candidates:
+                candidates = [e for e in self._endpoints if e not in exclude] or self._endpoints
+            n = len(self._endpoints)
+            endpoint = min(candidates, key=lambda e: (e.outstanding, (self._endpoints.index(e) - self._next) % n))
+            self._next += 1
+            endpoint.outstanding += 1
+            return endpoint
+
+    @staticmethod
+    def _is_replica_failure(err):
+        """Whether `err` says the replica is unhealthy, rather than the request being bad (token limit, non-retriable 4xx)."""
+        return not isinstance(err, TokenLimitError) and OpenAIChat._classify_error(err)[0]
+
+    def _release(self, endpoint, latency, error=None):
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.requests += 1
+            endpoint.latency += latency
+            if error is not None:
+                endpoint.errors += 1
+            if error is None or not self._is_replica_failure(error):
+                # The replica answered, even if the request itself was rejected.
+                endpoint.failures = 0
+                return
+            endpoint.failures += 1
+            if endpoint.healthy and endpoint.failures >= self.eject_after:
+                endpoint.healthy = False
+                logger.warning(f"Ejecting {endpoint.chat.api_url} after {endpoint.failures} consecutive failures.")
+
+    def _on_error(self, endpoint, err, attempt, tried, wait_for_connection):
+        """Returns the delay before retrying on another replica, or raises `err`."""
+        if isinstance(err, TokenLimitError):
+            raise err
+        # With --wait-for-model every other error is retried, like OpenAIChat does.
+        if not wait_for_connection and (not self._is_replica_failure(err) or attempt >= self._max_retries):
+            raise err
+        logger.warning(f"Retrying request on another replica after error on {endpoint.chat.api_url}.")
+        tried.append(endpoint)
+        if len(tried) < len(self._endpoints):
+            return 0
+        # Every replica failed once, back off before going around again.
+        tried.clear()
+        return endpoint.chat._controller.backoff(attempt)
+
+    def get_response(self, messages, wait_for_connection=False, n=None):
+        tried = []
+        for attempt in itertools.count():
+            endpoint = self._acquire(exclude=tried)
+            start = time.monotonic()
+            try:
+                response = endpoint.chat.get_response(messages, False, n)
+            except Exception as err:
+                self._release(endpoint, time.monotonic() - start, err)
+                time.sleep(self._on_error(endpoint, err, attempt, tried, wait_for_connection))
+                continue
+            self._release(endpoint, time.monotonic() - start)
+            return response
+
+    async def aget_response(self, messages, wait_for_connection=False, n=None):
+        if self._hedge is None:
+            return await self._aget_response(messages, wait_for_connection, n)
+        # The duplicate avoids the replica the first attempt is waiting on.
+        busy = []
+        return await run_hedged(self._hedge, lambda _: self._aget_response(messages, wait_for_connection, n, busy))
+
+    async def _aget_response(self, messages, wait_for_connection=False, n=None, busy=None):
+        tried = []
+        for attempt in itertools.count():
+            endpoint = self._acquire(exclude=tried + (busy or []))
+            if busy is not None:
+                busy.append(endpoint)
+            start = time.monotonic()
+            try:
+                response = await endpoint.chat.aget_response(messages, False, n)
+            except asyncio.CancelledError:
+                self._release(endpoint, time.monotonic() - start)
+                raise
+            except Exception as err:
+                self._release(endpoint, time.monotonic() - start, err)
+                await asyncio.sleep(self._on_error(endpoint, err, attempt, tried, wait_for_connection))
+                continue
+            self._release(endpoint, time.monotonic() - start)
+            return response
+
+    def _probe(self, endpoint):
+        try:
+            endpoint.chat._client.with_options(timeout=self.probe_interval).models.list()
+        except Exception as err:
+            with self._lock:
+                endpoint.failures += 1
+                if endpoint.healthy and endpoint.failures >= self.eject_after:
+                    endpoint.healthy = False
+                    logger.warning(f"Ejecting {endpoint.chat.api_url}, health probe failed: {err}")
+            return
+        with self._lock:
+            endpoint.failures = 0
+            if not endpoint.healthy:
+                endpoint.healthy = True
+                logger.info(f"Reinstating {endpoint.chat.api_url}, health probe succeeded.")
+
+    def _probe_loop(self):
+        while not self._stop.wait(self.probe_interval):
+            for endpoint in self._endpoints:
+                self._probe(endpoint)
+
+    def endpoint_stats(self):
+        with self._lock:
+            return {endpoint.chat.api_url: endpoint.stats() for endpoint in self._endpoints}
+
+    def log_stats(self):
+        self._transport.log_stats()
+        if self._hedge is not None:
+            self._hedge.log_stats(", ".join(self.api_urls))
+        if self._budget is not None:
+            self._budget.log_stats()
+        for url, stats in self.endpoint_stats().items():
+            mean_latency = f"{stats['mean_latency']:.3f}s" if stats["mean_latency"] is not None else "-"
+            logger.info(f"Endpoint {url}: {'healthy' if stats['healthy'] else 'ejected'}, {stats['requests']} requests, {stats['errors']} errors, mean latency {mean_latency}.")
+
+    def batch_body(self, messages, n=None):
+        # A batch is run offline, every replica would send the same body.
+        return self._endpoints[0].chat.batch_body(messages, n)
+
+    def parse_batch_response(self, body, n=None):
+        return self._endpoints[0].chat.parse_batch_response(body, n)
+
+    async def aclose(self):
+        self._stop.set()
+        for endpoint in self._endpoints:
+            await endpoint.chat.aclose()
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Optional
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class _TokenBucket:
+    """Budget refilled continuously at `per_minute / 60` units per second, holding at most `per_minute`."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self._rate = per_minute / 60
+        self._updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def wait_time(self, amount):
+        # A request larger than the whole budget is let through once the bucket is full.
+        needed = min(amount, self.capacity) - self.level
+        return max(0.0, needed / self._rate)
+
+
+class RateController:
+    """Concurrency and rate controller shared by all the requests of a model backend.
+
+    - The number of requests in flight is adapted with AIMD: it grows by about one per
+      round of successful requests and is halved on overload errors (429, 503,
+      timeouts) or when latency exceeds `latency_target`, at most once per round trip.
+    - Optional requests-per-minute and tokens-per-minute budgets are enforced with
+      token buckets. Budgets are given for the whole job and split evenly across the
+      `WORLD_SIZE` ranks.
+    - Retries use exponential backoff with full jitter, and a `Retry-After` from the
+      server pauses every request of the controller for that long.
+
+    Args:
+        max_inflight (int): Upper bound of concurrent requests.
+        min_inflight (int): Lower bound of concurrent requests.
+        initial_inflight (int, optional): Starting limit, `max_inflight` by default.
+        rpm (float, optional): Requests per minute for the whole job.
+        tpm (float, optional): Tokens (prompt + completion) per minute for the whole job.
+        max_retries (int): Retries of a failed request, unless waiting for the model.
+        backoff_base (float): Base delay in seconds of the exponential backoff.
+        backoff_max (float): Maximum backoff delay in seconds.
+        latency_target (float, optional): Latency in seconds above which the limit is decreased.
+    """
+
+    def __init__(self, max_inflight: int = 64, min_inflight: int = 1, initial_inflight: Optional[int] = None, rpm: Optional[float] = None, tpm: Optional[float] = None,
+                 max_retries: int = 5, backoff_base: float = 1.0, backoff_max: float = 60.0, latency_target: Optional[float] = None):
+        world_size = int(os.environ.get("WORLD_SIZE", 1))
+        self.max_inflight = max_inflight
+        self.min_inflight = min_inflight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.latency_target = latency_target
+        self._limit = float(initial_inflight or max_inflight)
+        self._inflight = 0
+        self._rpm = _TokenBucket(rpm / world_size) if rpm else None
+        self._tpm = _TokenBucket(tpm / world_size) if tpm else None
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._latency = None
+        self._lock = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def _try_acquire(self, tokens) -> float:
+        """Takes a slot if possible and returns 0, otherwise returns how long to wait."""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._inflight >= int(self._limit):
+            return 0.05
+        wait = 0.0
+        for bucket, amount in ((self._rpm, 1), (self._tpm, tokens)):
+            if bucket is not None:
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(amount))
+        if wait > 0:
+            return wait
+        if self._rpm is not None:
+            self._rpm.level -= 1
+        if self._tpm is not None:
+            self._tpm.level -= tokens
+        self._inflight += 1
+        return 0.0
+
+    def acquire(self, tokens: int = 0):
+        with self._lock:
+            while (wait := self._try_acquire(tokens)) > 0:
+                self._lock.wait(timeout=wait)
+
+    async def aacquire(self, tokens: int = 0):
+        while True:
+            with self._lock:
+                wait = self._try_acquire(tokens)
+            if wait == 0:
+                return
+            await asyncio.sleep(min(wait, 1.0))
+
+    def release(self, tokens: int, used_tokens: Optional[int], latency: float, overload: bool = False, retry_after: Optional[float] = None):
+        """Frees a slot and adapts the limit from the outcome of the request."""
+        now = time.monotonic()
+        with self._lock:
+            self._inflight -= 1
+            if self._tpm is not None and used_tokens is not None:
+                self._tpm.level += tokens - used_tokens
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+
+            self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+            slow = self.latency_target is not None and latency > self.latency_target
+            if overload or slow:
+                # Concurrent failures of the same congestion episode only count once.
+                if now - self._last_decrease > self._latency and self._limit > self.min_inflight:
+                    self._limit = max(self.min_inflight, self._limit / 2)
+                    self._last_decrease = now
+                    logger.info(f"Decreasing in-flight limit to {self.limit} ({'overload' if overload else 'slow responses'}).")
+            else:
+                self._limit = min(self.max_inflight, self._limit + 1 / self._limit)
+            self._lock.notify_all()
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Delay before retry number `attempt` (starting at 0)."""
+        if retry_after:
+            return retry_after + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def config(self):
+        return {"max_inflight": self.max_inflight, "min_inflight": self.min_inflight, "max_retries": self.max_retries,
+                "backoff_base": self.backoff_base, "backoff_max": self.backoff_max, "latency_target": self.latency_target,
+                "rpm": self._rpm.capacity if self._rpm else None, "tpm": self._tpm.capacity if self._tpm else None}
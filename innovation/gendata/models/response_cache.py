@@ -0,0 +1,158 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+from innovation.gendata.models.model_manager import BaseModel, n_kwargs
+from innovation.gendata.utils.logger import setup_logger
+from innovation.gendata.utils.metrics import metrics
+
+logger = setup_logger(__name__)
+
+
+class ResponseCache:
+    """Content-addressed cache of LLM responses stored in a local SQLite file.
+
+    The database runs in WAL mode with a busy timeout, so several torchrun ranks can
+    share the same file. When the stored responses exceed `max_size_mb`, the least
+    recently used entries are evicted.
+
+    Args:
+        path (str): Path to the SQLite database, created if it does not exist.
+        max_size_mb (float): Maximum size of the cached responses in megabytes.
+    """
+
+    def __init__(self, path: str, max_size_mb: float = 1024):
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO meta (name, value) VALUES ('size', 0)")
+
+    @staticmethod
+    def make_key(model: str, params: dict, messages) -> str:
+        """Hashes the model name, the resolved request parameters and the rendered messages."""
+        payload = json.dumps({"model": model, "params": params, "messages": messages}, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, value: str):
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock up front, so the size bookkeeping is consistent across ranks.
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                old_size = row[0] if row else 0
+                self._conn.execute("INSERT OR REPLACE INTO responses (key, value, size, accessed) VALUES (?, ?, ?, ?)", (key, value, size, time.time()))
+                self._conn.execute("UPDATE meta SET value = value + ? WHERE name = 'size'", (size - old_size,))
+                self._evict()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self):
+        total = self._conn.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+        while total > self.max_size:
+            rows = self._conn.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                if total <= self.max_size:
+                    break
+            self._conn.execute("UPDATE meta SET value = ? WHERE name = 'size'", (max(total, 0),))
+
+    def stats(self):
+        total = self._conn.execute("SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+        entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "size": total}
+
+    def close(self):
+        self._conn.close()
+
+
+class CachedModel(BaseModel):
+    """Wraps a model so that `get_response` is served from a `ResponseCache` when possible."""
+
+    def __init__(self, model: BaseModel, cache: ResponseCache):
+        self._model = model
+        self._cache = cache
+
+    def get_model_name(self):
+        return self._model.get_model_name()
+
+    def print_args(self):
+        self._model.print_args()
+        logger.info(f"Response cache: {self._cache.path} (max size: {self._cache.max_size / (1024 * 1024):.0f} MB)")
+
+    def supports_n(self):
+        return self._model.supports_n()
+
+    def _get_key(self, messages, n=None):
+        params = getattr(self._model, "model_params", {})
+        if n is not None:
+            params = {**params, "n": n}
+        return ResponseCache.make_key(self.get_model_name(), params, messages)
+
+    def get_response(self, messages, wait_for_connection=False, n=None):
+        key = self._get_key(messages, n)
+        response = self._cache.get(key)
+        if response is None:
+            metrics.inc("cache_misses_total")
+            response = self._model.get_response(messages, wait_for_connection, **n_kwargs(n))
+            # Several completions are stored together as a JSON list.
+            self._cache.put(key, response if n is None else json.dumps(response, ensure_ascii=False))
+        else:
+            metrics.inc("cache_hits_total")
+            logger.debug("Response served from cache.")
+            response = response if n is None else json.loads(response)
+        return response
+
+    async def aget_response(self, messages, wait_for_connection=False, n=None):
+        key = self._get_key(messages, n)
+        # SQLite may wait on other ranks' locks, so keep it off the event loop.
+        response = await asyncio.to_thread(self._cache.get, key)
+        if response is None:
+            metrics.inc("cache_misses_total")
+            response = await self._model.aget_response(messages, wait_for_connection, **n_kwargs(n))
+            await asyncio.to_thread(self._cache.put, key, response if n is None else json.dumps(response, ensure_ascii=False))
+        else:
+            metrics.inc("cache_hits_total")
+            logger.debug("Response served from cache.")
+            response = response if n is None else json.loads(response)
+        return response
+
+    def batch_body(self, messages, n=None):
+        return self._model.batch_body(messages, n)
+
+    def parse_batch_response(self, body, n=None):
+        return self._model.parse_batch_response(body, n)
+
+    async def aclose(self):
+        await self._model.aclose()
+
+    def log_stats(self):
+        self._model.log_stats()
+        stats = self._cache.stats()
+        logger.info(f"Response cache: {stats['hits']} hits, {stats['misses']} misses, {stats['entries']} entries ({stats['size'] / (1024 * 1024):.1f} MB).")
@@ -0,0 +1,125 @@
+import threading
+from collections import deque
+from typing import List, Optional
+import numpy as np
+from innovation.gendata.utils.logger import setup_logger
+from innovation.gendata.utils.metrics import metrics
+
+logger = setup_logger(__name__)
+
+# Finish reasons of responses ended on the client side, distinct from those sent by the server.
+EARLY_STOP_REASONS = ("json_close", "stop_sequence", "max_chars")
+
+
+class EarlyStop:
+    """Client-side conditions that end a streamed generation before the server does.
+
+    Args:
+        max_chars (int, optional): Abort once the output exceeds this many characters, the
+            response then fails like one that ran out of `max_tokens`.
+        json_close (bool): When the output starts with `{` or `[`, stop as soon as that
+            top-level value is closed, dropping anything generated after it.
+        stop (list, optional): Stop at the first of these strings, which is not included.
+    """
+
+    def __init__(self, max_chars: Optional[int] = None, json_close: bool = False, stop: Optional[List[str]] = None):
+        self.max_chars = max_chars
+        self.json_close = json_close
+        self.stop = list(stop or [])
+
+    def config(self):
+        return {"max_chars": self.max_chars, "json_close": self.json_close, "stop": self.stop}
+
+    def scanner(self) -> "_Scanner":
+        return _Scanner(self)
+
+
+class _Scanner:
+    """State of the early stop conditions for one response."""
+
+    def __init__(self, early_stop: EarlyStop):
+        self._early_stop = early_stop
+        self._longest_stop = max((len(s) for s in early_stop.stop), default=0)
+        self.content = ""
+        # JSON tracking: None until the first non-blank character, False when not JSON.
+        self._json = None if early_stop.json_close else False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def _scan_json(self, text: str, offset: int) -> Optional[int]:
+        for i, char in enumerate(text):
+            if self._json is None:
+                if char.isspace():
+                    continue
+                self._json = char in "{["
+                if not self._json:
+                    return None
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    return offset + i + 1
+        return None
+
+    def feed(self, text: str) -> Optional[str]:
+        """Adds streamed text, returns the reason to stop (one of `EARLY_STOP_REASONS`) or None.
+
+        When stopping, `content` holds the output to keep.
+        """
+        offset = len(self.content)
+        self.content += text
+        if self._json is not False:
+            end = self._scan_json(text, offset)
+            if end is not None:
+                self.content = self.content[:end]
+                return "json_close"
+        if self._longest_stop:
+            window = max(0, offset - self._longest_stop + 1)
+            positions = [p for p in (self.content.find(s, window) for s in self._early_stop.stop) if p >= 0]
+            if positions:
+                self.content = self.content[:min(positions)]
+                return "stop_sequence"
+        if self._early_stop.max_chars is not None and len(self.content) > self._early_stop.max_chars:
+            return "max_chars"
+        return None
+
+
+class StreamStats:
+    """Time to first token and inter-token latency of streamed responses, over the last `window` responses."""
+
+    def __init__(self, window: int = 10000):
+        self._lock = threading.Lock()
+        self._ttft = deque(maxlen=window)
+        self._itl = deque(maxlen=window)
+        self.early_stops = {}
+
+    def observe(self, start: float, chunk_times: List[float], finish_reason: Optional[str]):
+        with self._lock:
+            if chunk_times:
+                self._ttft.append(chunk_times[0] - start)
+                metrics.observe("time_to_first_token_seconds", chunk_times[0] - start)
+            if len(chunk_times) > 1:
+                self._itl.append((chunk_times[-1] - chunk_times[0]) / (len(chunk_times) - 1))
+                metrics.observe("inter_token_latency_seconds", self._itl[-1])
+            if finish_reason in EARLY_STOP_REASONS:
+                self.early_stops[finish_reason] = self.early_stops.get(finish_reason, 0) + 1
+
+    def log_stats(self):
+        with self._lock:
+            if not self._ttft:
+                return
+            ttft = np.percentile(self._ttft, [50, 95])
+            itl = np.mean(self._itl) if self._itl else 0.0
+            early_stops = ", ".join(f"{count} {reason}" for reason, count in self.early_stops.items()) or "none"
+        logger.info(f"Streaming: time to first token p50 {ttft[0]:.3f}s, p95 {ttft[1]:.3f}s; inter-token latency {1000 * itl:.1f} ms; early stops: {early_stops}.")
@@ -0,0 +1,175 @@
+import importlib.util
+import math
+import threading
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from innovation.gendata.utils.logger import setup_logger
+from innovation.gendata.utils.metrics import current_stage, metrics
+
+logger = setup_logger(__name__)
+
+
+class _CharTokenizer:
+    """Estimates token counts from the number of characters."""
+
+    def __init__(self, chars_per_token: float):
+        self.chars_per_token = chars_per_token
+
+    def count(self, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def count_messages(self, messages) -> Optional[int]:
+        return None
+
+
+class _TiktokenTokenizer:
+    def __init__(self, encoding: str):
+        if importlib.util.find_spec("tiktoken") is None:
+            raise ImportError("The 'tiktoken:' tokenizers require the 'tiktoken' package, install it with `pip install tiktoken`.")
+        import tiktoken
+        self._encoding = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str) -> int:
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def count_messages(self, messages) -> Optional[int]:
+        return None
+
+
+class _HFTokenizer:
+    def __init__(self, name: str):
+        if importlib.util.find_spec("transformers") is None:
+            raise ImportError("Hugging Face tokenizers require the 'transformers' package, install it with `pip install transformers`.")
+        from transformers import AutoTokenizer
+        self._tokenizer = AutoTokenizer.from_pretrained(name)
+
+    def count(self, text: str) -> int:
+        return len(self._tokenizer.encode(text, add_special_tokens=False))
+
+    def count_messages(self, messages) -> Optional[int]:
+        """Exact prompt length through the model's chat template, when it has one."""
+        if not getattr(self._tokenizer, "chat_template", None):
+            return None
+        return len(self._tokenizer.apply_chat_template(messages, tokenize=True, add_generation_prompt=True))
+
+
+def load_tokenizer(tokenizer: Optional[str], chars_per_token: float = 4.0):
+    """Returns a token counter: `tiktoken:<encoding>`, a Hugging Face tokenizer name or path, or a character estimate when None."""
+    if tokenizer is None:
+        return _CharTokenizer(chars_per_token)
+    if tokenizer.startswith("tiktoken:"):
+        return _TiktokenTokenizer(tokenizer[len("tiktoken:"):])
+    return _HFTokenizer(tokenizer)
+
+
+class TokenBudget:
+    """Chooses `max_tokens` for every request instead of sending the same static value.
+
+    Prompts are tokenized locally to know how much of the context window is left.
+    Once a task stage has `min_samples` responses, its budget is the `percentile`
+    of the output lengths seen for that stage times `headroom`, so the server does
+    not reserve KV-cache for tokens that are never generated. Until then, the
+    `max_tokens` of the model params is used. A response cut by the budget
+    (`finish_reason` 'length') is retried with twice the budget, up to what fits
+    in the context window, at most `max_retries` times.
+
+    Args:
+        context_window (int): Tokens the model accepts, prompt and completion together.
+        tokenizer (str, optional): Hugging Face tokenizer name or path, or `tiktoken:<encoding>`.
+            Without it, prompt lengths are estimated from `chars_per_token`.
+        chars_per_token (float): Characters per token of the estimate.
+        percentile (float): Percentile of the observed output lengths the budget is based on.
+        headroom (float): Factor applied to that percentile.
+        min_tokens (int): Smallest budget given to a request.
+        min_samples (int): Responses observed in a stage before its budget adapts.
+        max_retries (int): Retries with a larger budget of a response cut by `max_tokens`.
+        window (int): Number of recent output lengths kept per stage.
+        message_overhead (int): Tokens added per message for the chat format, when the tokenizer has no chat template.
+    """
+
+    def __init__(self, context_window: int, tokenizer: Optional[str] = None, chars_per_token: float = 4.0, percentile: float = 99,
+                 headroom: float = 1.5, min_tokens: int = 256, min_samples: int = 20, max_retries: int = 2, window: int = 1000,
+                 message_overhead: int = 8):
+        self.context_window = int(context_window)
+        self.tokenizer = tokenizer
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_tokens = min_tokens
+        self.min_samples = min_samples
+        self.max_retries = max_retries
+        self.message_overhead = message_overhead
+        self._tokenizer = load_tokenizer(tokenizer, chars_per_token)
+        self._window = window
+        self._lengths: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.retries = 0
+
+    def config(self):
+        return {"context_window": self.context_window, "tokenizer": self.tokenizer, "percentile": self.percentile, "headroom": self.headroom,
+                "min_tokens": self.min_tokens, "min_samples": self.min_samples, "max_retries": self.max_retries}
+
+    @staticmethod
+    def _stage():
+        stage = current_stage.get()
+        return "none" if stage is None else str(stage)
+
+    def count_prompt(self, messages: List[Dict[str, str]]) -> int:
+        """Tokens of the prompt, including the chat format."""
+        tokens = self._tokenizer.count_messages(messages)
+        if tokens is None:
+            tokens = sum(self._tokenizer.count(str(message.get("content", ""))) + self.message_overhead for message in messages)
+        return tokens
+
+    def plan(self, messages: List[Dict[str, str]], default_max_tokens: Optional[int]) -> Tuple[int, int]:
+        """Returns the prompt tokens and the `max_tokens` for a request of the current stage.
+
+        Raises:
+            ValueError: If the prompt does not leave room for any output in the context window.
+        """
+        prompt_tokens = self.count_prompt(messages)
+        room = self.context_window - prompt_tokens
+        if room <= 0:
+            raise ValueError(f"The prompt takes {prompt_tokens} tokens and leaves no room in the context window of {self.context_window} tokens.")
+        stage = self._stage()
+        with self._lock:
+            self.requests += 1
+            lengths = self._lengths.get(stage)
+            if lengths is not None and len(lengths) >= self.min_samples:
+                budget = max(self.min_tokens, math.ceil(float(np.percentile(lengths, self.percentile)) * self.headroom))
+            else:
+                budget = int(default_max_tokens) if default_max_tokens else room
+        budget = min(budget, room)
+        metrics.observe("max_tokens", budget)
+        return prompt_tokens, budget
+
+    def grow(self, prompt_tokens: int, budget: int, retry: int) -> Optional[int]:
+        """Budget for retry number `retry` of a response cut at `budget`, or None when it cannot grow."""
+        room = self.context_window - prompt_tokens
+        if retry >= self.max_retries or budget >= room:
+            return None
+        with self._lock:
+            self.retries += 1
+        metrics.inc("length_retries_total")
+        return min(budget * 2, room)
+
+    def observe(self, content: Optional[str], completion_tokens: Optional[int]):
+        """Records the output length of a complete response in the current stage."""
+        if completion_tokens is None:
+            completion_tokens = self._tokenizer.count(content or "")
+        stage = self._stage()
+        with self._lock:
+            if stage not in self._lengths:
+                self._lengths[stage] = deque(maxlen=self._window)
+            self._lengths[stage].append(completion_tokens)
+
+    def log_stats(self):
+        with self._lock:
+            stages = {stage: (len(lengths), float(np.percentile(lengths, 50)), float(np.percentile(lengths, self.percentile)))
+                      for stage, lengths in self._lengths.items() if lengths}
+            requests, retries = self.requests, self.retries
+        if not requests:
+            return
+        parts = [f"stage {stage} p50 {p50:.0f} p{self.percentile:g} {high:.0f} ({count} samples)" for stage, (count, p50, high) in sorted(stages.items())]
+        logger.info(f"Token budget: {requests} requests, {retries} retried after 'length'; output tokens: {'; '.join(parts) or 'none'}.")
@@ -0,0 +1,131 @@
+import importlib.util
+import json
+import threading
+import time
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class _ConnectionStats:
+    """Counts requests and new connections from the httpcore `trace` extension."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.connect_time = 0.0
+
+    def record(self, name: str, started: dict):
+        # Each traced operation emits `<name>.started` and then `<name>.complete` or `<name>.failed`.
+        operation, _, phase = name.rpartition(".")
+        if phase == "started":
+            started[operation] = time.monotonic()
+            if operation.endswith("send_request_headers"):
+                with self._lock:
+                    self.requests += 1
+        elif phase == "complete" and operation in ("connection.connect_tcp", "connection.start_tls"):
+            with self._lock:
+                self.connections += operation == "connection.connect_tcp"
+                self.connect_time += time.monotonic() - started.pop(operation, time.monotonic())
+
+    def on_request(self, request):
+        started = {}
+        request.extensions["trace"] = lambda name, info: self.record(name, started)
+
+    async def aon_request(self, request):
+        started = {}
+
+        async def trace(name, info):
+            self.record(name, started)
+        request.extensions["trace"] = trace
+
+    def snapshot(self):
+        with self._lock:
+            return {"requests": self.requests, "connections": self.connections, "connect_time": self.connect_time,
+                    "reuse_ratio": 1 - self.connections / self.requests if self.requests else None}
+
+
+class HTTPTransport:
+    """Connection pools shared by the OpenAI clients of the model layer.
+
+    Backends built with the same settings share one sync and one async `httpx` client,
+    so replicas and retries reuse kept-alive connections instead of each client
+    opening its own pool. Connection reuse is measured on the client side.
+
+    Args:
+        max_connections (int): Maximum open connections per client.
+        max_keepalive_connections (int): Idle connections kept open for reuse.
+        keepalive_expiry (float): Seconds an idle connection is kept open.
+        http2 (bool): Use HTTP/2 when the server supports it, requires the `h2` package.
+        connect_timeout (float): Seconds to establish a connection.
+        read_timeout (float): Seconds to wait for response data.
+        write_timeout (float): Seconds to send request data.
+        pool_timeout (float): Seconds to wait for a free connection of the pool.
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_connections: int = 1000, max_keepalive_connections: int = 100, keepalive_expiry: float = 5.0, http2: bool = False,
+                 connect_timeout: float = 5.0, read_timeout: float = 600.0, write_timeout: float = 600.0, pool_timeout: float = 600.0):
+        if http2 and importlib.util.find_spec("h2") is None:
+            raise ImportError("HTTP/2 requires the 'h2' package, install it with `pip install httpx[http2]`.")
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.http2 = http2
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.pool_timeout = pool_timeout
+        self._stats = _ConnectionStats()
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, **config) -> "HTTPTransport":
+        """Returns the transport for `config`, creating it on first use."""
+        key = json.dumps(config, sort_keys=True)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(**config)
+            return cls._shared[key]
+
+    def config(self):
+        return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+
+    def _client_args(self):
+        import httpx
+        return {
+            "limits": httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_keepalive_connections, keepalive_expiry=self.keepalive_expiry),
+            "timeout": httpx.Timeout(connect=self.connect_timeout, read=self.read_timeout, write=self.write_timeout, pool=self.pool_timeout),
+            "http2": self.http2,
+        }
+
+    def client(self):
+        from openai import DefaultHttpxClient
+        with self._lock:
+            if self._client is None or self._client.is_closed:
+                self._client = DefaultHttpxClient(**self._client_args(), event_hooks={"request": [self._stats.on_request]})
+            return self._client
+
+    def async_client(self):
+        from openai import DefaultAsyncHttpxClient
+        with self._lock:
+            # An async client is bound to the event loop it first ran on, a closed one is replaced for the next loop.
+            if self._async_client is None or self._async_client.is_closed:
+                self._async_client = DefaultAsyncHttpxClient(**self._client_args(), event_hooks={"request": [self._stats.aon_request]})
+            return self._async_client
+
+    def stats(self):
+        return self._stats.snapshot()
+
+    def log_stats(self):
+        stats = self.stats()
+        if not stats["requests"]:
+            return
+        mean_connect = stats["connect_time"] / stats["connections"] if stats["connections"] else 0.0
+        logger.info(f"HTTP transport: {stats['requests']} requests over {stats['connections']} new connections "
+                    f"({100 * stats['reuse_ratio']:.1f}% reused), mean connection setup {1000 * mean_connect:.1f} ms.")
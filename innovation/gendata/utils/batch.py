@@ -0,0 +1,97 @@
+import json
+import os
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+BATCH_URL = "/v1/chat/completions"
+
+
+def custom_id(key, stage: int) -> str:
+    """Identifier of the request of task `stage` for the record with unique key `key`."""
+    return f"{key}:{stage}"
+
+
+def parse_custom_id(value: str) -> Tuple[str, int]:
+    """Returns the unique key (as a string) and the stage of a `custom_id`."""
+    key, _, stage = value.rpartition(":")
+    if not key or not stage.isdigit():
+        raise ValueError(f"Invalid custom_id '{value}', expected '<unique key>:<stage>'.")
+    return key, int(stage)
+
+
+def write_requests(path: str, requests: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+    """Writes `(custom_id, body)` pairs as an OpenAI Batch input file and returns the number of requests.
+
+    The file is written under a temporary name and renamed, so a batch runner never reads a partial file.
+    """
+    tmp_path = path + ".tmp"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for request_id, body in requests:
+            f.write(json.dumps({"custom_id": request_id, "method": "POST", "url": BATCH_URL, "body": body}, ensure_ascii=False) + "\n")
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+def read_results(path: str) -> Iterator[Tuple[str, Optional[Dict[str, Any]], Optional[str]]]:
+    """Yields `(custom_id, response body, error)` for every line of an OpenAI Batch output file.
+
+    The body is None for failed requests, with the reason in `error`.
+    """
+    with open(path, "rb") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.warning(f"Skipping invalid line {number} of {path}: {e}")
+                continue
+            response = result.get("response") or {}
+            if result.get("error"):
+                yield result.get("custom_id"), None, json.dumps(result["error"], ensure_ascii=False)
+            elif response.get("status_code", 200) != 200 or not response.get("body"):
+                yield result.get("custom_id"), None, f"status {response.get('status_code')}: {json.dumps(response.get('body'), ensure_ascii=False)}"
+            else:
+                yield result.get("custom_id"), response["body"], None
+
+
+def run_batch(input_path: str, output_path: str, api_url: str, api_key: str = "xyz", concurrency: int = 8):
+    """Local stand-in for an offline batch runner: sends every request of a batch input file to an
+    OpenAI-compatible server and writes the OpenAI Batch output file, in input order."""
+    from concurrent.futures import ThreadPoolExecutor
+    from openai import OpenAI
+
+    client = OpenAI(base_url=api_url, api_key=api_key, max_retries=2)
+
+    def call(line):
+        request = json.loads(line)
+        try:
+            body = client.chat.completions.create(**request["body"]).model_dump()
+            return {"id": f"batch_req_{request['custom_id']}", "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": body}, "error": None}
+        except Exception as e:
+            return {"id": f"batch_req_{request['custom_id']}", "custom_id": request["custom_id"], "response": None,
+                    "error": {"message": str(e)}}
+
+    with open(input_path, "r", encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+    with ThreadPoolExecutor(concurrency) as pool, open(output_path, "w", encoding="utf-8") as out:
+        for result in pool.map(call, lines):
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+    logger.info(f"Wrote {len(lines)} results to {output_path}.")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run an OpenAI Batch input file against an OpenAI-compatible server.")
+    parser.add_argument("--input", type=str, required=True, help="Batch input file written by --batch-export.")
+    parser.add_argument("--output", type=str, required=True, help="Path of the batch output file to import with --batch-import.")
+    parser.add_argument("--api-url", type=str, default="http://localhost:8080/v1/", help="Base url of the OpenAI-compatible server.")
+    parser.add_argument("--api-key", type=str, default="xyz", help="API key of the server.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of requests sent at once.")
+    args = parser.parse_args()
+    run_batch(args.input, args.output, args.api_url, args.api_key, args.concurrency)
@@ -0,0 +1,38 @@
+import os
+import sys
+from typing import Any, List
+
+
+def get_rank() -> int:
+    """Rank of the process from the launcher's environment, usable before the process group exists."""
+    return int(os.environ.get('RANK', 0))
+
+
+def is_distributed() -> bool:
+    """Whether a torch.distributed process group is running."""
+    # Without torch loaded there can be no process group, and checking must not import it.
+    if "torch.distributed" not in sys.modules:
+        return False
+    import torch.distributed as dist
+    return dist.is_available() and dist.is_initialized()
+
+
+def barrier():
+    if is_distributed():
+        import torch.distributed as dist
+        dist.barrier()
+
+
+def all_gather_object(object_list: List[Any], obj: Any):
+    """Gathers `obj` of every rank into `object_list`, which only holds the own object in a single process."""
+    if is_distributed():
+        import torch.distributed as dist
+        dist.all_gather_object(object_list, obj)
+    else:
+        object_list[0] = obj
+
+
+def broadcast_object_list(object_list: List[Any], src: int = 0):
+    if is_distributed():
+        import torch.distributed as dist
+        dist.broadcast_object_list(object_list, src=src)
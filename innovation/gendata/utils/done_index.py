@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import zlib
+from typing import Dict, Iterable, List
+import numpy as np
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# One entry per record written to a shard: the key hash, its input index and the frame of its line.
+ENTRY_DTYPE = np.dtype([("key", "<u8"), ("index", "<u8"), ("end", "<u8"), ("length", "<u4"), ("crc", "<u4")])
+
+# Input index of records whose key is not found in the input, they are placed last.
+UNKNOWN_INDEX = int(np.iinfo(np.uint64).max)
+
+
+def key_hash(value) -> int:
+    """Stable 64-bit hash of a unique key value."""
+    return int.from_bytes(hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def hash_keys(values: Iterable) -> np.ndarray:
+    return np.fromiter((key_hash(value) for value in values), dtype=np.uint64)
+
+
+def sidecar_path(shard_path: str) -> str:
+    return shard_path + ".done"
+
+
+def make_entry(value, index: int, end: int, payload: bytes) -> bytes:
+    """Frames a line of `payload` bytes ending at offset `end` of its shard, generated from input record `index`."""
+    return np.array([(key_hash(value), index, end, len(payload), zlib.crc32(payload))], dtype=ENTRY_DTYPE).tobytes()
+
+
+class DoneIndex:
+    """Set of completed unique keys, stored as a sorted array of 64-bit hashes.
+
+    Every temporary shard has a `.done` sidecar acting as its commit log: after a
+    record's line is appended to the shard, an entry with the key hash, the line's
+    end offset, its length and its CRC32 is appended to the sidecar. Resuming only
+    reads these entries, recovering from a crash only checks the last of them, and
+    the input index lets the final output be merged back into input order.
+    """
+
+    def __init__(self, hashes: np.ndarray):
+        self._hashes = np.unique(hashes)
+
+    def __len__(self):
+        return len(self._hashes)
+
+    @staticmethod
+    def read_entries(shard_path: str) -> np.ndarray:
+        path = sidecar_path(shard_path)
+        size = os.path.getsize(path) // ENTRY_DTYPE.itemsize
+        return np.fromfile(path, dtype=ENTRY_DTYPE, count=size)
+
+    @classmethod
+    def load(cls, shard_paths: List[str]) -> "DoneIndex":
+        parts = [cls.read_entries(path)["key"] for path in shard_paths if os.path.exists(sidecar_path(path))]
+        return cls(np.concatenate(parts) if parts else np.empty(0, dtype=np.uint64))
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """Vectorised membership test, returns a boolean mask aligned with `hashes`."""
+        if len(self._hashes) == 0:
+            return np.zeros(len(hashes), dtype=bool)
+        positions = np.searchsorted(self._hashes, hashes)
+        positions[positions == len(self._hashes)] = 0
+        return self._hashes[positions] == hashes
+
+    @staticmethod
+    def append(shard_path: str, value, index: int, payload: bytes):
+        """Appends `payload` as one framed record: the line to the shard, then its entry to the sidecar."""
+        with open(shard_path, "ab") as f:
+            f.write(payload)
+            end = f.tell()
+        with open(sidecar_path(shard_path), "ab") as f:
+            f.write(make_entry(value, index, end, payload))
+
+    @staticmethod
+    def recover(shard_path: str) -> int:
+        """Brings a shard back to its last committed record and returns that offset.
+
+        Only the newest entries are verified against the shard, so the cost does not
+        depend on the shard size. Bytes after the last good record (a torn line, or a
+        line whose entry was never written) are truncated, as is a torn sidecar entry.
+        """
+        entries = DoneIndex.read_entries(shard_path)
+        shard_size = os.path.getsize(shard_path)
+        good = len(entries)
+        with open(shard_path, "rb") as f:
+            while good > 0:
+                entry = entries[good - 1]
+                end, length = int(entry["end"]), int(entry["length"])
+                if length <= end <= shard_size:
+                    f.seek(end - length)
+                    if zlib.crc32(f.read(length)) == int(entry["crc"]):
+                        break
+                good -= 1
+        offset = int(entries[good - 1]["end"]) if good else 0
+
+        if good != len(entries) or os.path.getsize(sidecar_path(shard_path)) != good * ENTRY_DTYPE.itemsize:
+            logger.warning(f"Truncating {sidecar_path(shard_path)} to its {good} committed entries.")
+            os.truncate(sidecar_path(shard_path), good * ENTRY_DTYPE.itemsize)
+        if shard_size != offset:
+            logger.warning(f"Truncating torn tail of {shard_path} ({shard_size - offset} bytes), last good offset: {offset}.")
+            os.truncate(shard_path, offset)
+        return offset
+
+    @staticmethod
+    def rebuild(shard_path: str, key: str, index_of: Dict[str, int]):
+        """Writes the sidecar of a shard that has none, e.g. one moved in by hand, from its records.
+
+        `index_of` maps the string form of every input key to its input index.
+        """
+        logger.info(f"Building done index for {shard_path}.")
+        tmp_path = sidecar_path(shard_path) + ".tmp"
+        with open(shard_path, "rb") as infile, open(tmp_path, "wb") as outfile:
+            end = 0
+            for line in infile:
+                end += len(line)
+                if line.strip():
+                    value = json.loads(line).get(key)
+                    outfile.write(make_entry(value, index_of.get(str(value), UNKNOWN_INDEX), end, line))
+        os.replace(tmp_path, sidecar_path(shard_path))
@@ -0,0 +1,196 @@
+import heapq
+import json
+import os
+import shutil
+import time
+from typing import Iterator, List, Optional, Tuple
+import numpy as np
+from innovation.gendata.utils.done_index import DoneIndex, UNKNOWN_INDEX
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def _in_range(indices: np.ndarray, index_range: Tuple[int, Optional[int]]) -> np.ndarray:
+    start, end = index_range
+    mask = indices >= start
+    if end is not None:
+        mask &= indices < end
+    return mask
+
+
+def _iter_shard(shard_path: str, index_range: Optional[Tuple[int, Optional[int]]] = None) -> Iterator[Tuple[int, int, bytes]]:
+    """Yields `(input index, key hash, line)` for the committed records of a shard, sorted by input index.
+
+    With `index_range=(start, end)` only records whose input index falls in `[start, end)`
+    are read, `end=None` meaning no upper bound.
+    """
+    entries = DoneIndex.read_entries(shard_path)
+    if index_range is not None:
+        entries = entries[_in_range(entries["index"], index_range)]
+    entries = entries[np.argsort(entries["index"], kind="stable")]
+    fd = os.open(shard_path, os.O_RDONLY)
+    try:
+        for entry in entries:
+            end, length = int(entry["end"]), int(entry["length"])
+            yield int(entry["index"]), int(entry["key"]), os.pread(fd, length, end - length)
+    finally:
+        os.close(fd)
+
+
+def iter_merged(shard_paths: List[str], index_range: Optional[Tuple[int, Optional[int]]] = None) -> Iterator[bytes]:
+    """K-way merges the shards by input index, yielding each record's JSON line once."""
+    last_index, keys = None, set()
+    for index, key, line in heapq.merge(*[_iter_shard(path, index_range) for path in shard_paths], key=lambda item: item[0]):
+        if index != last_index:
+            last_index, keys = index, set()
+        # The same record may appear in two shards, e.g. when one was moved in by hand. An input
+        # record generating several variants has one output record per variant key.
+        elif index != UNKNOWN_INDEX and key in keys:
+            continue
+        keys.add(key)
+        yield line
+
+
+class _Progress:
+    def __init__(self, total: int, every: float = 10.0):
+        self.total = total
+        self.count = 0
+        self._every = every
+        self._last = time.time()
+
+    def update(self, count: int = 1):
+        self.count += count
+        if time.time() - self._last >= self._every or self.count == self.total:
+            self._last = time.time()
+            logger.info(f"Saved {self.count}/{self.total} records ({100 * self.count / max(self.total, 1):.1f}%).")
+
+
+def _batches(lines: Iterator[bytes], size: int) -> Iterator[List[dict]]:
+    batch = []
+    for line in lines:
+        batch.append(json.loads(line))
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def count_records(shard_paths: List[str], index_range: Optional[Tuple[int, Optional[int]]] = None) -> int:
+    total = 0
+    for path in shard_paths:
+        indices = DoneIndex.read_entries(path)["index"]
+        total += len(indices) if index_range is None else int(_in_range(indices, index_range).sum())
+    return total
+
+
+def collect_columns(shard_paths: List[str], index_range: Optional[Tuple[int, Optional[int]]] = None) -> List[str]:
+    """Pass over the records collecting the union of their keys, in order of appearance."""
+    columns = {}
+    for line in iter_merged(shard_paths, index_range):
+        columns.update(dict.fromkeys(json.loads(line)))
+    return list(columns)
+
+
+def collect_schema(shard_paths: List[str], index_range: Optional[Tuple[int, Optional[int]]] = None, batch_size: int = 1000):
+    """Pass over the records unifying their arrow schema, since a field may be null in the first batches."""
+    import pyarrow as pa
+    schemas = [pa.Table.from_pylist(batch).schema for batch in _batches(iter_merged(shard_paths, index_range), batch_size)]
+    return pa.unify_schemas(schemas, promote_options="permissive") if schemas else pa.schema([])
+
+
+def collect_layout(shard_paths: List[str], file_type: str, index_range: Optional[Tuple[int, Optional[int]]] = None):
+    """Returns what has to be known about all records before writing: CSV columns or the parquet schema."""
+    if file_type == "csv":
+        return collect_columns(shard_paths, index_range)
+    elif file_type == "parquet":
+        return collect_schema(shard_paths, index_range)
+    return None
+
+
+def merge_layouts(layouts: list, file_type: str):
+    """Combines the layouts collected by several ranks into one shared by all parts."""
+    if file_type == "csv":
+        return list(dict.fromkeys(column for columns in layouts for column in columns))
+    elif file_type == "parquet":
+        import pyarrow as pa
+        return pa.unify_schemas([schema for schema in layouts if len(schema)] or [pa.schema([])], promote_options="permissive")
+    return None
+
+
+def write_output(shard_paths: List[str], output: str, file_type: str, batch_size: int = 1000, index_range: Optional[Tuple[int, Optional[int]]] = None, layout=None, part: Optional[int] = None):
+    """Streams the records of all shards into `output` in input order, with bounded memory.
+
+    JSONL lines are copied as they are, JSON is written as an array record by record,
+    and CSV and parquet are written in batches of `batch_size` records (one parquet
+    row group per batch) after a first pass that collects the columns or the schema,
+    unless `layout` already holds them.
+
+    When `part` is given, `output` is one part of a larger file and only the records
+    in `index_range` are written: JSON parts have no brackets and only CSV part 0
+    has a header, so parts can be concatenated as they are.
+    """
+    total = count_records(shard_paths, index_range)
+    progress = _Progress(total)
+    tmp_output = output + ".tmp"
+    if layout is None:
+        layout = collect_layout(shard_paths, file_type, index_range)
+
+    if file_type == "jsonl":
+        with open(tmp_output, "wb") as f:
+            for line in iter_merged(shard_paths, index_range):
+                f.write(line)
+                progress.update()
+    elif file_type == "json":
+        with open(tmp_output, "w", encoding="utf-8") as f:
+            if part is None:
+                f.write("[\n")
+            for i, line in enumerate(iter_merged(shard_paths, index_range)):
+                if i:
+                    f.write(",\n")
+                f.write(json.dumps(json.loads(line), indent=4, ensure_ascii=False))
+                progress.update()
+            if part is None:
+                f.write("\n]\n")
+    elif file_type == "csv":
+        import pandas as pd
+        header = part is None or part == 0
+        with open(tmp_output, "w", encoding="utf-8", newline="") as f:
+            for i, batch in enumerate(_batches(iter_merged(shard_paths, index_range), batch_size)):
+                pd.DataFrame(batch, columns=layout).to_csv(f, header=(header and i == 0), index=False)
+                progress.update(len(batch))
+            if total == 0 and header:
+                pd.DataFrame(columns=layout).to_csv(f, index=False)
+    elif file_type == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        with pq.ParquetWriter(tmp_output, layout) as writer:
+            for batch in _batches(iter_merged(shard_paths, index_range), batch_size):
+                writer.write_table(pa.Table.from_pylist(batch, schema=layout), row_group_size=batch_size)
+                progress.update(len(batch))
+    else:
+        raise ValueError(f"Unsupported file type: {file_type}")
+
+    os.replace(tmp_output, output)
+    return total
+
+
+def concatenate_parts(part_paths: List[str], output: str, file_type: str):
+    """Joins part files of a single-file format into `output` with plain byte copies."""
+    tmp_output = output + ".tmp"
+    with open(tmp_output, "wb") as f:
+        if file_type == "json":
+            f.write(b"[\n")
+        first = True
+        for path in part_paths:
+            if file_type == "json" and os.path.getsize(path) == 0:
+                continue
+            if file_type == "json" and not first:
+                f.write(b",\n")
+            first = False
+            with open(path, "rb") as part:
+                shutil.copyfileobj(part, f)
+        if file_type == "json":
+            f.write(b"\n]\n")
+    os.replace(tmp_output, output)
@@ -0,0 +1,274 @@
+import contextlib
+import json
+import math
+import os
+import resource
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Task of `messages_list` being generated, set by the data method so the model layer can label its metrics.
+current_stage: ContextVar[Optional[int]] = ContextVar("current_stage", default=None)
+
+# Upper bounds of the histogram buckets: powers of two from about 1 ms (or 1 token) to about 12 days (or 1M tokens).
+BUCKETS = [2.0 ** k for k in range(-10, 21)] + [math.inf]
+
+_NO_STAGE = "none"
+
+
+@contextlib.contextmanager
+def stage_scope(stage: int):
+    """Labels the metrics recorded inside the block with task `stage`."""
+    token = current_stage.set(stage)
+    try:
+        yield
+    finally:
+        current_stage.reset(token)
+
+
+class Histogram:
+    """Fixed-bucket histogram that can be merged across ranks."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "Histogram"):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimates a quantile by interpolating inside its bucket, clamped to the observed range."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if BUCKETS[i] != math.inf else self.max
+                value = lower + (upper - lower) * (rank - seen) / count
+                return min(max(value, self.min), self.max)
+            seen += count
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.sum, "min": self.min if self.count else None, "max": self.max if self.count else None,
+                "mean": self.sum / self.count if self.count else None,
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99), "buckets": self.counts}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.counts = list(data["buckets"])
+        histogram.count = data["count"]
+        histogram.sum = data["sum"]
+        histogram.min = data["min"] if data["min"] is not None else math.inf
+        histogram.max = data["max"] if data["max"] is not None else -math.inf
+        return histogram
+
+
+class Metrics:
+    """Process-wide counters and histograms, labelled by metric name and task stage.
+
+    When `stage` is not given the current stage set with `stage_scope` is used.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[str, float]] = {}
+        self._histograms: Dict[str, Dict[str, Histogram]] = {}
+        self.start_time = time.time()
+
+    @staticmethod
+    def _stage(stage):
+        stage = current_stage.get() if stage is None else stage
+        return _NO_STAGE if stage is None else str(stage)
+
+    def inc(self, name: str, amount: float = 1, stage: Optional[int] = None):
+        stage = self._stage(stage)
+        with self._lock:
+            counters = self._counters.setdefault(name, {})
+            counters[stage] = counters.get(stage, 0) + amount
+
+    def observe(self, name: str, value: float, stage: Optional[int] = None):
+        stage = self._stage(stage)
+        with self._lock:
+            self._histograms.setdefault(name, {}).setdefault(stage, Histogram()).observe(value)
+
+    def counter(self, name: str) -> float:
+        """Total of a counter over all stages."""
+        with self._lock:
+            return sum(self._counters.get(name, {}).values())
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.start_time = time.time()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "elapsed": time.time() - self.start_time,
+                "peak_rss_bytes": peak_rss_bytes(),
+                "counters": {name: dict(stages) for name, stages in self._counters.items()},
+                "histograms": {name: {stage: h.to_dict() for stage, h in stages.items()} for name, stages in self._histograms.items()},
+            }
+
+
+metrics = Metrics()
+
+
+def peak_rss_bytes() -> int:
+    """Peak resident memory of this process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def merge_snapshots(snapshots: List[dict]) -> dict:
+    """Adds up the snapshots of several ranks."""
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, stages in snapshot["counters"].items():
+            for stage, value in stages.items():
+                counters.setdefault(name, {})
+                counters[name][stage] = counters[name].get(stage, 0) + value
+        for name, stages in snapshot["histograms"].items():
+            for stage, data in stages.items():
+                histograms.setdefault(name, {}).setdefault(stage, Histogram()).merge(Histogram.from_dict(data))
+    return {
+        "elapsed": max((snapshot["elapsed"] for snapshot in snapshots), default=0.0),
+        "peak_rss_bytes": max((snapshot.get("peak_rss_bytes", 0) for snapshot in snapshots), default=0),
+        "counters": counters,
+        "histograms": {name: {stage: h.to_dict() for stage, h in stages.items()} for name, stages in histograms.items()},
+    }
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def to_prometheus(snapshots: List[dict], prefix: str = "gendata") -> str:
+    """Formats per-rank snapshots in the Prometheus text exposition format, e.g. for the node exporter textfile collector."""
+    lines = [f"# TYPE {prefix}_elapsed_seconds gauge"]
+    for rank, snapshot in enumerate(snapshots):
+        lines.append(f"{prefix}_elapsed_seconds{_labels(rank=rank)} {snapshot['elapsed']}")
+    lines.append(f"# TYPE {prefix}_peak_rss_bytes gauge")
+    for rank, snapshot in enumerate(snapshots):
+        lines.append(f"{prefix}_peak_rss_bytes{_labels(rank=rank)} {snapshot.get('peak_rss_bytes', 0)}")
+    for name in sorted({name for snapshot in snapshots for name in snapshot["counters"]}):
+        lines.append(f"# TYPE {prefix}_{name} counter")
+        for rank, snapshot in enumerate(snapshots):
+            for stage, value in snapshot["counters"].get(name, {}).items():
+                lines.append(f"{prefix}_{name}{_labels(rank=rank, stage=stage)} {value}")
+    for name in sorted({name for snapshot in snapshots for name in snapshot["histograms"]}):
+        lines.append(f"# TYPE {prefix}_{name} histogram")
+        for rank, snapshot in enumerate(snapshots):
+            for stage, data in snapshot["histograms"].get(name, {}).items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS, data["buckets"]):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append(f"{prefix}_{name}_bucket{_labels(rank=rank, stage=stage, le=le)} {cumulative}")
+                lines.append(f"{prefix}_{name}_sum{_labels(rank=rank, stage=stage)} {data['sum']}")
+                lines.append(f"{prefix}_{name}_count{_labels(rank=rank, stage=stage)} {data['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def write_report(snapshots: List[dict], path: str):
+    """Writes the gathered metrics as a Prometheus textfile (`.prom`) or as JSON (any other extension)."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        if path.endswith(".prom"):
+            f.write(to_prometheus(snapshots))
+        else:
+            json.dump({"world_size": len(snapshots), "total": merge_snapshots(snapshots), "ranks": snapshots}, f, indent=2)
+    # Replaced atomically so a collector never reads a partial file.
+    os.replace(tmp_path, path)
+
+
+def log_summary(snapshot: dict):
+    """Logs the main figures of a (merged) snapshot, one line per stage."""
+    elapsed = max(snapshot["elapsed"], 1e-9)
+    records = sum(snapshot["counters"].get("records_total", {}).values())
+    logger.info(f"Metrics: {records:.0f} records in {elapsed:.1f}s ({records / elapsed:.2f} records/s).")
+    latencies = snapshot["histograms"].get("request_latency_seconds", {})
+    stages = (set(latencies) | {stage for stages in snapshot["counters"].values() for stage in stages}) - {_NO_STAGE}
+    for stage in sorted(stages, key=int):
+        parts = []
+        latency = latencies.get(stage)
+        if latency and latency["count"]:
+            parts.append(f"{latency['count']} requests, latency p50 {latency['p50']:.3f}s p95 {latency['p95']:.3f}s p99 {latency['p99']:.3f}s")
+        for name, label in (("queue_wait_seconds", "queue wait"),):
+            histogram = snapshot["histograms"].get(name, {}).get(stage)
+            if histogram and histogram["count"]:
+                parts.append(f"{label} p50 {histogram['p50']:.3f}s")
+        for name in ("prompt_tokens", "completion_tokens"):
+            histogram = snapshot["histograms"].get(name, {}).get(stage)
+            if histogram and histogram["count"]:
+                parts.append(f"{name.replace('_', ' ')} {histogram['sum']:.0f}")
+        for name in ("retries_total", "length_retries_total", "request_errors_total", "json_errors_total", "cache_hits_total"):
+            value = snapshot["counters"].get(name, {}).get(stage)
+            if value:
+                parts.append(f"{name[:-len('_total')].replace('_', ' ')} {value:.0f}")
+        if parts:
+            logger.info(f"Metrics (stage {stage}): {', '.join(parts)}.")
+
+
+class ThroughputReporter:
+    """Background thread logging the records and completion tokens per second every `interval` seconds."""
+
+    def __init__(self, interval: float, total: Optional[int] = None):
+        self.interval = interval
+        self.total = total
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ThroughputReporter", daemon=True)
+
+    def _completion_tokens(self):
+        histograms = metrics.snapshot()["histograms"].get("completion_tokens", {})
+        return sum(h["sum"] for h in histograms.values())
+
+    def _run(self):
+        start = last_time = time.time()
+        last_records, last_tokens = 0, 0
+        while not self._stop.wait(self.interval):
+            now = time.time()
+            records, tokens = metrics.counter("records_total"), self._completion_tokens()
+            window = max(now - last_time, 1e-9)
+            progress = f"{records:.0f}/{self.total}" if self.total is not None else f"{records:.0f}"
+            logger.info(f"Throughput: {progress} records, {(records - last_records) / window:.2f} records/s "
+                        f"({records / max(now - start, 1e-9):.2f} overall), {(tokens - last_tokens) / window:.1f} completion tokens/s.")
+            last_time, last_records, last_tokens = now, records, tokens
+
+    def __enter__(self):
+        if self.interval > 0:
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
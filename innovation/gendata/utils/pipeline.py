@@ -0,0 +1,74 @@
+import asyncio
+import time
+from typing import Callable, Iterable
+from innovation.gendata.utils.logger import setup_logger
+from innovation.gendata.utils.metrics import metrics
+
+logger = setup_logger(__name__)
+
+
+class StagePipeline:
+    """Runs the tasks of `messages_list` as a pipeline of bounded stage queues.
+
+    Each task (stage) has its own pool of workers, so record i+1 runs stage 0 while
+    record i is already in stage 1. Requests of the same stage, which share their
+    prompt prefix, therefore reach the server close together.
+
+    Args:
+        data_instance (BaseMethod): Data method implementing `init_record`, `agenerate_task` and `finish_record`.
+        aget_llm_response (AsyncGetLLMResponseType): Awaitable used to call the model.
+        workers (int): Number of workers per stage.
+        queue_size (int): Maximum number of records waiting in front of each stage.
+    """
+
+    def __init__(self, data_instance, aget_llm_response, workers: int, queue_size: int):
+        self._data_instance = data_instance
+        self._aget_llm_response = aget_llm_response
+        self._workers = workers
+        self._queue_size = queue_size
+        self._num_stages = len(data_instance.messages_list)
+
+    async def run(self, indices: Iterable[int], on_record: Callable[[int, dict, float], None]):
+        """Generates every index in `indices`, calling `on_record(index, data, elapsed)` once a record is complete."""
+        queues = [asyncio.Queue(maxsize=self._queue_size) for _ in range(self._num_stages)]
+
+        async def feed():
+            for i in indices:
+                if self._data_instance.is_done(i):
+                    continue
+                # Records with checkpointed tasks enter the pipeline at their first incomplete task.
+                stage = self._data_instance.resume_stage(i)
+                await queues[stage].put((i, self._data_instance.init_record(i), time.time(), time.time()))
+
+        async def stage_worker(stage):
+            queue = queues[stage]
+            while True:
+                i, record, start_time, queued_time = await queue.get()
+                metrics.observe("queue_wait_seconds", time.time() - queued_time, stage=stage)
+                try:
+                    record = await self._data_instance.agenerate_task(record, stage, i, self._aget_llm_response)
+                    if stage + 1 < self._num_stages:
+                        await queues[stage + 1].put((i, record, start_time, time.time()))
+                    else:
+                        on_record(i, self._data_instance.finish_record(record, i), time.time() - start_time)
+                finally:
+                    queue.task_done()
+
+        async def drain():
+            await feed()
+            # Every item is forwarded before task_done, so joining stages in order waits for all of them.
+            for queue in queues:
+                await queue.join()
+
+        workers = [asyncio.create_task(stage_worker(stage)) for stage in range(self._num_stages) for _ in range(self._workers)]
+        drain_task = asyncio.create_task(drain())
+        try:
+            # Workers only stop by raising, so the first task to complete is either the drain or a failure.
+            await asyncio.wait([drain_task, *workers], return_when=asyncio.FIRST_COMPLETED)
+            for task in [drain_task, *workers]:
+                if task.done() and not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in [drain_task, *workers]:
+                task.cancel()
+            await asyncio.gather(drain_task, *workers, return_exceptions=True)
@@ -0,0 +1,312 @@
+import bisect
+import hashlib
+import json
+import os
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class RecordReader(ABC):
+    """Lazy, index-addressable access to the records of an input dataset.
+
+    Readers load the parts of the input that are actually accessed, so a rank only
+    materialises the rows it generates instead of the whole dataset.
+    """
+
+    columns: List[str]
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @abstractmethod
+    def record(self, index: int, columns: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        """Returns the record at `index` as a dict, restricted to `columns` when given."""
+        pass
+
+    @abstractmethod
+    def column(self, name: str) -> List[Any]:
+        """Returns all the values of a single column, reading only that column when the format allows it."""
+        pass
+
+    def take(self, indices: Sequence[int], columns: Sequence[str]) -> Dict[str, List[Any]]:
+        """Returns `columns` of the records at `indices` as one list of values per column."""
+        records = [self.record(index, columns) for index in indices]
+        return {name: [record.get(name) for record in records] for name in columns}
+
+
+class _ChunkCache:
+    """Keeps the most recently used chunks of records in memory."""
+
+    def __init__(self, size: int):
+        self._size = size
+        self._chunks = OrderedDict()
+
+    def get(self, key, load):
+        if key in self._chunks:
+            self._chunks.move_to_end(key)
+            return self._chunks[key]
+        chunk = load(key)
+        self._chunks[key] = chunk
+        if len(self._chunks) > self._size:
+            self._chunks.popitem(last=False)
+        return chunk
+
+
+class DataFrameReader(RecordReader):
+    """Reader for formats that can only be parsed as a whole (JSON arrays and CSV)."""
+
+    def __init__(self, df):
+        self._df = df
+        self.columns = list(df.columns)
+        # Columns converted to lists on first use, indexing them is much cheaper than `iloc` row access.
+        self._values = {}
+
+    def __len__(self):
+        return len(self._df)
+
+    def _column_values(self, name):
+        if name not in self._values:
+            self._values[name] = self._df[name].tolist()
+        return self._values[name]
+
+    def record(self, index, columns=None):
+        if not -len(self._df) <= index < len(self._df):
+            raise IndexError(f"Record {index} out of range.")
+        names = self.columns if columns is None else [name for name in columns if name in self._df.columns]
+        return {name: self._column_values(name)[index] for name in names}
+
+    def column(self, name):
+        return self._df[name].tolist()
+
+    def take(self, indices, columns):
+        return {name: [self._column_values(name)[index] for index in indices] if name in self._df.columns else [None] * len(indices)
+                for name in columns}
+
+
+class ParquetReader(RecordReader):
+    """Reads parquet files row group by row group, using the footer metadata for the row count."""
+
+    def __init__(self, path: str, cache_size: int = 2):
+        import pyarrow.parquet as pq
+        self._file = pq.ParquetFile(path)
+        metadata = self._file.metadata
+        self.columns = self._file.schema_arrow.names
+        self._starts = []
+        total = 0
+        for i in range(metadata.num_row_groups):
+            self._starts.append(total)
+            total += metadata.row_group(i).num_rows
+        self._num_rows = total
+        self._cache = _ChunkCache(cache_size)
+
+    def __len__(self):
+        return self._num_rows
+
+    def _load_row_group(self, key):
+        row_group, columns = key
+        if columns is None:
+            return self._file.read_row_group(row_group).to_pylist()
+        # A subset of columns is kept columnar, only the requested columns are decoded.
+        return self._file.read_row_group(row_group, columns=[name for name in columns if name in self.columns]).to_pydict()
+
+    def _locate(self, index):
+        if not 0 <= index < self._num_rows:
+            raise IndexError(f"Record {index} out of range.")
+        row_group = bisect.bisect_right(self._starts, index) - 1
+        return row_group, index - self._starts[row_group]
+
+    def record(self, index, columns=None):
+        row_group, offset = self._locate(index)
+        if columns is None:
+            return dict(self._cache.get((row_group, None), self._load_row_group)[offset])
+        values = self._cache.get((row_group, tuple(columns)), self._load_row_group)
+        return {name: values[name][offset] for name in columns if name in values}
+
+    def take(self, indices, columns):
+        columns = tuple(columns)
+        result = {name: [] for name in columns}
+        for index in indices:
+            row_group, offset = self._locate(index)
+            values = self._cache.get((row_group, columns), self._load_row_group)
+            for name in columns:
+                result[name].append(values[name][offset] if name in values else None)
+        return result
+
+    def column(self, name):
+        return self._file.read(columns=[name]).column(0).to_pylist()
+
+
+class JsonlReader(RecordReader):
+    """Reads single JSONL records through a memory-mapped byte-offset index.
+
+    The index holds the start offset of every record plus the file size as a final
+    sentinel. It is built once and cached next to the input as `.{filename}.idx`,
+    together with the input's size and mtime so a modified input is re-indexed.
+    The same pass collects the keys of every record, in order of first appearance,
+    cached as `.{filename}.columns`. Fetching a record then reads and parses just its line.
+    """
+
+    _MAGIC = 0x67656E64617461  # "gendata"
+    _HEADER = 4  # magic, input size, input mtime_ns, number of records
+
+    def __init__(self, path: str):
+        self._path = path
+        self._fd = os.open(path, os.O_RDONLY)
+        self._offsets, self.columns = self._load_index(path)
+        self._num_rows = len(self._offsets) - 1
+
+    def __del__(self):
+        if getattr(self, "_fd", None) is not None:
+            os.close(self._fd)
+
+    @staticmethod
+    def _index_path(path):
+        directory, filename = os.path.split(path)
+        return os.path.join(directory, f".{filename}.idx")
+
+    @staticmethod
+    def _columns_path(path):
+        directory, filename = os.path.split(path)
+        return os.path.join(directory, f".{filename}.columns")
+
+    @classmethod
+    def _load_columns(cls, path, stat):
+        columns_path = cls._columns_path(path)
+        if not os.path.exists(columns_path):
+            return None
+        try:
+            with open(columns_path, "rb") as f:
+                cached = json.load(f)
+            if cached.get("size") == stat.st_size and cached.get("mtime_ns") == stat.st_mtime_ns:
+                return cached["columns"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    @classmethod
+    def _load_index(cls, path):
+        """Returns the record offsets and the columns of `path`, from the cache when it is up to date."""
+        import numpy as np
+        stat = os.stat(path)
+        index_path = cls._index_path(path)
+        if os.path.exists(index_path):
+            header = np.fromfile(index_path, dtype=np.uint64, count=cls._HEADER)
+            if len(header) == cls._HEADER and header[0] == cls._MAGIC and header[1] == stat.st_size and header[2] == stat.st_mtime_ns:
+                columns = cls._load_columns(path, stat)
+                if columns is not None:
+                    offsets = np.memmap(index_path, dtype=np.uint64, mode="r", offset=cls._HEADER * 8, shape=(int(header[3]) + 1,))
+                    return offsets, columns
+            logger.info(f"Index {index_path} is stale, rebuilding it.")
+
+        offsets, columns = cls._build_offsets(path)
+        offsets.append(stat.st_size)
+        data = np.array([cls._MAGIC, stat.st_size, stat.st_mtime_ns, len(offsets) - 1] + offsets, dtype=np.uint64)
+        # Several ranks may build the index at once, each writes its own temporary files.
+        # The columns are written first, a valid index is only trusted together with them.
+        columns_path = cls._columns_path(path)
+        for target, write in ((columns_path, lambda tmp: cls._write_columns(tmp, stat, columns)), (index_path, data.tofile)):
+            tmp_path = f"{target}.{os.getpid()}.tmp"
+            try:
+                write(tmp_path)
+                os.replace(tmp_path, target)
+            except (OSError, TypeError, ValueError) as err:
+                logger.warning(f"Could not cache index for {path} ({err}), keeping it in memory.")
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                break
+        return data[cls._HEADER:], columns
+
+    @staticmethod
+    def _write_columns(path, stat, columns):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "columns": columns}, f, ensure_ascii=False)
+
+    @staticmethod
+    def _build_offsets(path):
+        """Returns the offset of every non-blank line and the union of the keys of their records."""
+        offsets = []
+        columns = {}
+        with open(path, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    offsets.append(offset)
+                    # A dict keeps the order in which the keys first appear, like pandas does.
+                    columns.update(dict.fromkeys(json.loads(line)))
+                offset += len(line)
+        return offsets, list(columns)
+
+    def __len__(self):
+        return self._num_rows
+
+    def record(self, index, columns=None):
+        if not 0 <= index < self._num_rows:
+            raise IndexError(f"Record {index} out of range.")
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        # pread does not move a shared file position, so concurrent readers are safe.
+        record = json.loads(os.pread(self._fd, end - start, start))
+        return record if columns is None else {name: record[name] for name in columns if name in record}
+
+    @staticmethod
+    def _column_path(path, name):
+        directory, filename = os.path.split(path)
+        # Column names may hold any character, the file is named after a hash of it.
+        digest = hashlib.blake2b(name.encode("utf-8"), digest_size=8).hexdigest()
+        return os.path.join(directory, f".{filename}.{digest}.col")
+
+    def column(self, name):
+        """Returns the values of column `name`, cached next to the input as `.{filename}.{hash}.col`.
+
+        Like the offset index, the cache holds the input's size and mtime and is rebuilt
+        when they change, so only the first run parses every line for the unique key.
+        """
+        stat = os.stat(self._path)
+        column_path = self._column_path(self._path, name)
+        if os.path.exists(column_path):
+            try:
+                with open(column_path, "rb") as f:
+                    cached = json.load(f)
+                if cached.get("size") == stat.st_size and cached.get("mtime_ns") == stat.st_mtime_ns and cached.get("name") == name:
+                    return cached["values"]
+            except (OSError, ValueError):
+                pass
+            logger.info(f"Column cache {column_path} is stale, rebuilding it.")
+
+        values = []
+        with open(self._path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    values.append(json.loads(line).get(name))
+        # Several ranks may build the cache at once, each writes its own temporary file.
+        tmp_path = f"{column_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"name": name, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "values": values}, f, ensure_ascii=False)
+            os.replace(tmp_path, column_path)
+        except (OSError, TypeError, ValueError) as err:
+            logger.warning(f"Could not cache column '{name}' of {self._path} ({err}), keeping it in memory.")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return values
+
+
+def open_reader(path: str, file_type: str) -> RecordReader:
+    """Returns the lazy reader for `path`, falling back to pandas for formats without partial reads."""
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"File not found: {path}")
+    if file_type == "jsonl":
+        return JsonlReader(path)
+    elif file_type == "parquet":
+        return ParquetReader(path)
+
+    import pandas as pd
+    if file_type == "json":
+        return DataFrameReader(pd.read_json(path))
+    elif file_type == "csv":
+        return DataFrameReader(pd.read_csv(path))
+    raise ValueError(f"Unsupported file type: {file_type}")
@@ -0,0 +1,162 @@
+import atexit
+import os
+import queue
+import signal
+import threading
+import time
+import weakref
+from innovation.gendata.utils.done_index import make_entry, sidecar_path
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+FSYNC_POLICIES = ("none", "close", "batch")
+
+_open_writers = weakref.WeakSet()
+_handlers_installed = False
+_FLUSH = object()
+_CLOSE = object()
+
+
+class RecordWriter:
+    """Long-lived background writer that group-commits records to a shard and its sidecar.
+
+    Records are queued by `write` and committed in batches by a background thread,
+    once `flush_size` records are waiting or `flush_interval` seconds have passed.
+    A batch is committed by appending all its lines to the shard and only then its
+    entries to the `.done` sidecar, so a crash can lose at most the queued records,
+    which are generated again on resume.
+
+    Args:
+        shard_path (str): Temporary JSONL shard of the rank.
+        flush_interval (float): Maximum seconds a record waits before being written.
+        flush_size (int): Number of queued records that triggers a write.
+        fsync (str): `none` leaves syncing to the OS, `close` syncs when the writer is closed and `batch` after every batch.
+        queue_size (int): Maximum queued records, `write` blocks when the queue is full.
+    """
+
+    def __init__(self, shard_path: str, flush_interval: float = 1.0, flush_size: int = 64, fsync: str = "none", queue_size: int = 1024):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unsupported fsync policy '{fsync}', expected one of {FSYNC_POLICIES}.")
+        self.shard_path = shard_path
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.fsync = fsync
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._shard = open(shard_path, "ab")
+        self._sidecar = open(sidecar_path(shard_path), "ab")
+        self._offset = self._shard.seek(0, os.SEEK_END)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="RecordWriter", daemon=True)
+        self._thread.start()
+        _open_writers.add(self)
+
+    def write(self, key, index: int, payload: bytes):
+        """Queues one record generated from input record `index`, `payload` being its full JSON line."""
+        self._raise_error()
+        self._queue.put((key, (index, payload)))
+
+    def flush(self):
+        """Blocks until every record queued so far is written."""
+        done = threading.Event()
+        self._queue.put((_FLUSH, done))
+        done.wait()
+        self._raise_error()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put((_CLOSE, None))
+        self._thread.join()
+        if self.fsync != "none" and self._error is None:
+            self._sync()
+        self._shard.close()
+        self._sidecar.close()
+        _open_writers.discard(self)
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f"Writing records to {self.shard_path} failed.") from self._error
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                key, payload = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                key, payload = _FLUSH, None
+
+            if key is _FLUSH or key is _CLOSE:
+                self._commit(batch)
+                batch, deadline = [], None
+                if payload is not None:
+                    payload.set()
+                if key is _CLOSE:
+                    return
+                continue
+
+            batch.append((key, payload))
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            if len(batch) >= self.flush_size:
+                self._commit(batch)
+                batch, deadline = [], None
+
+    def _commit(self, batch):
+        if not batch or self._error is not None:
+            return
+        try:
+            entries = []
+            for key, (index, payload) in batch:
+                self._offset += len(payload)
+                entries.append(make_entry(key, index, self._offset, payload))
+            self._shard.write(b"".join(payload for _, (_, payload) in batch))
+            self._shard.flush()
+            if self.fsync == "batch":
+                os.fsync(self._shard.fileno())
+            # Entries are written after the lines they describe, so the sidecar never points past the shard.
+            self._sidecar.write(b"".join(entries))
+            self._sidecar.flush()
+            if self.fsync == "batch":
+                os.fsync(self._sidecar.fileno())
+            logger.debug(f"Committed {len(batch)} records to {self.shard_path}.")
+        except Exception as err:
+            logger.error(f"Failed to write records to {self.shard_path}: {err}")
+            self._error = err
+
+    def _sync(self):
+        os.fsync(self._shard.fileno())
+        os.fsync(self._sidecar.fileno())
+
+
+def close_all():
+    """Flushes and closes every open writer, used on exit and on termination signals."""
+    for writer in list(_open_writers):
+        try:
+            writer.close()
+        except Exception as err:
+            logger.error(f"{err}")
+
+
+def _handle_signal(signum, frame):
+    # Only request the shutdown: the handler may interrupt the main thread inside `write`, holding the
+    # queue's lock, so flushing here could deadlock. SystemExit unwinds through the `finally` blocks that
+    # close the writers, and `close_all` runs again at exit.
+    logger.warning(f"Received signal {signum}, flushing records before exiting.")
+    raise SystemExit(128 + signum)
+
+
+def install_handlers():
+    """Makes sure queued records are written when the process exits or is terminated."""
+    global _handlers_installed
+    if _handlers_installed:
+        return
+    _handlers_installed = True
+    atexit.register(close_all)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, _handle_signal)
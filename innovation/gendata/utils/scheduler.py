@@ -0,0 +1,85 @@
+import fcntl
+from typing import Callable, Iterator, Sequence
+from innovation.gendata.utils import distributed
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class StoreCounter:
+    """Atomic counter kept in a torch.distributed key-value store, shared by all ranks."""
+
+    def __init__(self, store, key: str):
+        self._store = store
+        self._key = key
+
+    def __call__(self) -> int:
+        return self._store.add(self._key, 1) - 1
+
+
+class FileCounter:
+    """Atomic counter kept in a file lease, for when no distributed store is available."""
+
+    def __init__(self, path: str):
+        self._path = path
+
+    def reset(self):
+        with open(self._path, "w") as f:
+            f.write("0")
+
+    def __call__(self) -> int:
+        with open(self._path, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                value = int(f.read() or 0)
+                f.seek(0)
+                f.truncate()
+                f.write(str(value + 1))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return value
+
+
+def get_default_store():
+    """Returns the store backing the default process group, or None if it is not reachable."""
+    if not distributed.is_distributed():
+        return None
+    import torch.distributed as dist
+    try:
+        return dist.distributed_c10d._get_default_store()
+    except Exception as err:
+        logger.warning(f"Distributed store is not available ({err}), falling back to a file lease.")
+        return None
+
+
+class ChunkScheduler:
+    """Hands out small chunks of pending indices on demand.
+
+    Every rank builds the scheduler from the same list of pending indices and pulls
+    chunk numbers from a shared counter, so ranks keep taking work until the queue
+    is empty instead of being bound to a fixed slice of the dataset.
+
+    Args:
+        pending (Sequence[int]): Indices that still have to be generated, identical on every rank.
+        chunk_size (int): Number of indices handed out per request to the counter.
+        counter (Callable[[], int]): Returns the next chunk number, shared across ranks.
+    """
+
+    def __init__(self, pending: Sequence[int], chunk_size: int, counter: Callable[[], int]):
+        if chunk_size < 1:
+            raise ValueError(f"Chunk size must be greater than 0, got {chunk_size}.")
+        self._pending = pending
+        self._chunk_size = chunk_size
+        self._counter = counter
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __iter__(self) -> Iterator[int]:
+        while True:
+            start = self._counter() * self._chunk_size
+            if start >= len(self._pending):
+                return
+            logger.debug(f"Taking chunk {start}:{start + self._chunk_size} of {len(self._pending)} pending records.")
+            yield from self._pending[start:start + self._chunk_size]
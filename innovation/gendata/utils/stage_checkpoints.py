@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Dict, Iterator, List
+from innovation.gendata.utils.done_index import DoneIndex, hash_keys, key_hash
+from innovation.gendata.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def stage_fingerprints(messages_list, output_keys, output_types) -> List[str]:
+    """Fingerprint of the tasks up to each stage, a checkpoint is only reused while these tasks are unchanged."""
+    fingerprints = []
+    for stage in range(len(messages_list)):
+        tasks = [messages_list[:stage + 1], output_keys[:stage + 1], output_types[:stage + 1]]
+        fingerprints.append(hashlib.blake2b(json.dumps(tasks, sort_keys=True).encode("utf-8"), digest_size=8).hexdigest())
+    return fingerprints
+
+
+class StageCheckpoints:
+    """Append-only log of the completed stages of records that are still in progress.
+
+    Each completed stage but the last appends one JSON line with the record's unique
+    key, the stage, the fingerprint of the tasks up to that stage and the keys the
+    stage added to the record. A resumed run restores those keys and starts the
+    record at its first incomplete stage instead of paying for the earlier calls again.
+
+    Args:
+        path (str): Checkpoint file of the rank, `._{name}_{rank}.stages` next to its temporary shard.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def append(self, key, stage: int, fingerprint: str, values: Dict[str, Any]):
+        line = (json.dumps({"key": key, "stage": stage, "task": fingerprint, "values": values}, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock:
+            if self._fd is None:
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            # A single write per line, so a crash can only tear the last one.
+            os.write(self._fd, line)
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    @staticmethod
+    def read(path: str) -> Iterator[dict]:
+        """Yields the entries of a checkpoint file, skipping torn or invalid lines."""
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    @classmethod
+    def compact(cls, path: str, done_index: DoneIndex, fingerprints: List[str]):
+        """Drops the entries of records that are done, of changed tasks and torn lines, removing the file if nothing is left."""
+        kept = [entry for entry in cls.read(path)
+                if 0 <= entry.get("stage", -1) < len(fingerprints) and entry.get("task") == fingerprints[entry["stage"]]]
+        if kept:
+            done = done_index.contains(hash_keys(entry["key"] for entry in kept))
+            kept = [entry for entry, is_done in zip(kept, done) if not is_done]
+        if not kept:
+            os.remove(path)
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for entry in kept:
+                f.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+        os.replace(tmp_path, path)
+        logger.info(f"Kept {len(kept)} stage checkpoints of unfinished records in {path}.")
+
+    @classmethod
+    def load(cls, paths: List[str], fingerprints: List[str]) -> Dict[int, Dict[int, Dict[str, Any]]]:
+        """Maps the key hash of every checkpointed record to the values of its completed stages."""
+        checkpoints = {}
+        for path in paths:
+            for entry in cls.read(path):
+                stage = entry.get("stage", -1)
+                if 0 <= stage < len(fingerprints) and entry.get("task") == fingerprints[stage]:
+                    checkpoints.setdefault(key_hash(entry["key"]), {})[stage] = entry["values"]
+        return checkpoints
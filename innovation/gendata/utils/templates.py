@@ -0,0 +1,61 @@
+import string
+from typing import Any, Dict, List, Mapping
+
+_CONVERSIONS = {"s": str, "r": repr, "a": ascii}
+
+
+def field_root(field_name: str) -> str:
+    """Name of the record key a replacement field reads, e.g. `a` for `{a.b}` or `{a[0]}`."""
+    for i, char in enumerate(field_name):
+        if char in ".[":
+            return field_name[:i]
+    return field_name
+
+
+class CompiledTemplate:
+    """A message template parsed once into literal text and replacement fields.
+
+    Rendering gives the same result as `template.format(**values)`, including
+    conversions, format specs and `{{`/`}}` escapes, without parsing the template
+    again for every record. Templates with positional fields or nested format specs
+    keep using `str.format`, so they fail the same way.
+
+    Args:
+        template (str): Template with `str.format` replacement fields.
+    """
+
+    _formatter = string.Formatter()
+
+    def __init__(self, template: str):
+        self.template = template
+        parsed = list(self._formatter.parse(template))
+        # Replacement fields in order of appearance, as returned by `_get_replaceable_keys`.
+        self.fields = [field_name for _, field_name, _, _ in parsed if field_name]
+        # Record keys the template reads, without duplicates.
+        self.keys = list(dict.fromkeys(field_root(field_name) for field_name in self.fields))
+        self._fallback = any(field_name is not None and (not field_root(field_name) or field_root(field_name).isdigit() or "{" in (spec or ""))
+                             for _, field_name, spec, _ in parsed)
+        self._parts = [(literal, field_name, field_name is not None and field_root(field_name) != field_name, spec or "", conversion)
+                       for literal, field_name, spec, conversion in parsed]
+        # A template without fields or escapes renders to itself.
+        self.static = not self.fields and "{" not in template and "}" not in template
+
+    def render(self, values: Mapping[str, Any]) -> str:
+        """Fills the template with `values`, raising KeyError for a missing key like `str.format`."""
+        if self._fallback:
+            return self.template.format(**values)
+        pieces = []
+        for literal, field_name, nested, spec, conversion in self._parts:
+            pieces.append(literal)
+            if field_name is None:
+                continue
+            value = self._formatter.get_field(field_name, (), values)[0] if nested else values[field_name]
+            if conversion:
+                value = _CONVERSIONS[conversion](value)
+            pieces.append(format(value, spec))
+        return "".join(pieces)
+
+
+def compile_messages(messages: List[Dict[str, str]]) -> List[CompiledTemplate]:
+    """Compiles the content of every message of a task."""
+    return [CompiledTemplate(message["content"]) for message in messages]
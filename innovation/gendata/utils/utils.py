@@ -30,4 +30,23 @@ def generate_tmp_paths(path, number):
     name, _ = os.path.splitext(filename)  # Split filename and extension
     new_filename = f"._{name}_{number}.jsonl"  # Insert number before extension
     pattern = f"._{name}_*.jsonl"  # Insert number before extension
-    return os.path.join(directory, pattern), os.path.join(directory, new_filename)  # Reconstruct full path
\ No newline at end of file
+    return os.path.join(directory, pattern), os.path.join(directory, new_filename)  # Reconstruct full path
+
+def generate_lease_path(path):
+    directory, filename = os.path.split(path)
+    name, _ = os.path.splitext(filename)
+    return os.path.join(directory, f"._{name}.lease")  # Shared work counter when no distributed store is available
+
+def get_shard_range(total, rank, world_size):
+    """Returns the contiguous `[start, end)` slice of `total` items that belongs to `rank`."""
+    local_size = total // world_size
+    remainder = total % world_size
+
+    # Distribute remainder elements across initial ranks
+    if rank < remainder:
+        start_idx = rank * (local_size + 1)
+        end_idx = start_idx + local_size + 1
+    else:
+        start_idx = rank * local_size + remainder
+        end_idx = start_idx + local_size
+    return start_idx, end_idx